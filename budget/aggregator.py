@@ -4,6 +4,7 @@ from datetime import date, datetime
 from operator import itemgetter
 
 from database import *
+from serializer import EXPENSE_FIELDS, serialise_expense_rows
 
 
 class Aggregator(object):
@@ -20,15 +21,6 @@ class Aggregator(object):
         now = datetime.now()
         return self._range_for_month(now.year, now.month)
 
-    @staticmethod
-    def _round_dict_values(dictionary, decimal_places):
-        for key in dictionary.iterkeys():
-            if isinstance(dictionary[key], dict):
-                dictionary[key] = Aggregator._round_dict_values(dictionary[key], decimal_places)
-            else:
-                dictionary[key] = float('%.2f' % round(dictionary[key], decimal_places))
-        return dictionary
-
     @staticmethod
     def _friendly_name(name):
         parent, child = name.split('/', 1)
@@ -40,41 +32,150 @@ class Aggregator(object):
     def _sorted_by_dict_value(dictionary):
         return OrderedDict(sorted(dictionary.items(), key=itemgetter(1), reverse=True))
 
-    def get_expenses_for_month(self, person, year, month):
-        first_day, last_day = self._range_for_month(year, month)
-        expenses_by_group = defaultdict(lambda: defaultdict(list))
-        total_sum_by_group = defaultdict(int)
+    @staticmethod
+    def _group_rows(rows):
+        rows_by_group = defaultdict(lambda: defaultdict(list))
+        for row in rows:
+            rows_by_group[row.group]["{}/{}".format(row.parent_category, row.child_category)].append(row)
+        return rows_by_group
+
+    @staticmethod
+    def _serialise_rows_by_group(rows_by_group, columnar):
+        expenses_by_group = defaultdict(lambda: defaultdict(lambda: serialise_expense_rows([], columnar)))
+        for group, rows_by_category in rows_by_group.iteritems():
+            for category, rows in rows_by_category.iteritems():
+                expenses_by_group[group][category] = serialise_expense_rows(rows, columnar)
+        return expenses_by_group
+
+    def _get_expenses_by_group(self, person, first_day, last_day, columnar=False):
+        rows = self.db.get_expense_rows_between(person.user_id, first_day, last_day, EXPENSE_FIELDS)
+        return self._serialise_rows_by_group(self._group_rows(rows), columnar)
+
+    def _summarise(self, totals, expenses_by_group=None, by_category=True):
+        """Build the response from totals per group and category, attaching the expenses if given"""
+        total_sum_by_group = defaultdict(float)
         total_sum_by_category = defaultdict(lambda: defaultdict(float))
-        total_sum = 0
+        total_sum = 0.0
 
-        for expense in self.db.get_expenses_between(person.user_id, first_day, last_day):
-            expenses_by_group[expense.group][expense.category].append(expense.as_dictionary())
-            total_sum_by_group[expense.group] += expense.cost
-            total_sum_by_category[expense.group][expense.category] += expense.cost
-            total_sum += expense.cost
+        for total in totals:
+            category = "{}/{}".format(total.parent_category, total.child_category)
+            total_sum_by_group[total.group] += total.total
+            total_sum_by_category[total.group][category] += total.total
+            total_sum += total.total
 
         # Round to two decimal places
-        total_sum_by_group = self._round_dict_values(total_sum_by_group, 2)
-        total_sum_by_category = self._round_dict_values(total_sum_by_category, 2)
-        total_sum = float('%.2f' % round(total_sum, 2))
+        total_sum_by_group = dict((group, round(value, 2)) for group, value in total_sum_by_group.iteritems())
+        total_sum = round(total_sum, 2)
+
+        if not by_category:
+            return {
+                "total_sum_by_group": total_sum_by_group,
+                "total_sum": total_sum
+            }
 
-        for group in total_sum_by_category.iterkeys():
+        for group in total_sum_by_category.keys():
             sorted_total_sum_by_category = self._sorted_by_dict_value(total_sum_by_category[group])
             total_sum_by_category_for_group = []
             for category, total_sum_for_category in sorted_total_sum_by_category.items():
-                total_sum_by_category_for_group.append({
+                parent_category, child_category = category.split('/', 1)
+                category_summary = {
                     "name": self._friendly_name(category),
-                    "total_sum": total_sum_for_category,
-                    "expenses": expenses_by_group[group][category]
-                })
+                    "parent_category": parent_category,
+                    "child_category": child_category,
+                    "total_sum": round(total_sum_for_category, 2)
+                }
+                if expenses_by_group is not None:
+                    category_summary["expenses"] = expenses_by_group[group][category]
+                total_sum_by_category_for_group.append(category_summary)
             total_sum_by_category[group] = total_sum_by_category_for_group
 
         return {
             "total_sum_by_group": total_sum_by_group,
-            "total_sum_by_category": total_sum_by_category,
+            "total_sum_by_category": dict(total_sum_by_category),
             "total_sum": total_sum
         }
 
-    def get_expenses_for_this_month(self, person):
+    def get_expenses_between(self, person, first_day, last_day, detail=False, columnar=False):
+        """Summarise expenses for an arbitrary range of days, with totals computed by the database"""
+        totals = self.db.get_totals_between(person.user_id, first_day, last_day)
+        expenses_by_group = self._get_expenses_by_group(person, first_day, last_day, columnar) if detail else None
+        return self._summarise(totals, expenses_by_group)
+
+    @classmethod
+    def _months_between(cls, from_year, from_month, to_year, to_month):
+        year, month = from_year, from_month
+        while (year, month) <= (to_year, to_month):
+            yield year, month
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def get_expenses_for_months(self, person, from_year, from_month, to_year, to_month, detail=False, columnar=False):
+        """Summarise each month in a range, using a single grouped query for the totals of all months"""
+        first_day, _ = self._range_for_month(from_year, from_month)
+        _, last_day = self._range_for_month(to_year, to_month)
+
+        totals_by_month = defaultdict(list)
+        for total in self.db.get_totals_between(person.user_id, first_day, last_day, by_month=True):
+            totals_by_month[(int(total.year), int(total.month))].append(total)
+
+        rows_by_month = defaultdict(list)
+        if detail:
+            for row in self.db.get_expense_rows_between(person.user_id, first_day, last_day, EXPENSE_FIELDS):
+                rows_by_month[(row.created_at.year, row.created_at.month)].append(row)
+
+        months = {}
+        for year, month in self._months_between(from_year, from_month, to_year, to_month):
+            months["%04d-%02d" % (year, month)] = self._summarise(
+                totals_by_month[(year, month)],
+                self._serialise_rows_by_group(self._group_rows(rows_by_month[(year, month)]), columnar)
+                if detail else None
+            )
+
+        return {
+            "months": months,
+            "total_sum": round(sum(summary["total_sum"] for summary in months.values()), 2)
+        }
+
+    def get_summary_for_year(self, person, year, to_month=12):
+        """Summarise a year up to and including to_month, and each of its months, from the monthly rollup alone"""
+        totals_by_month = defaultdict(list)
+        for total in self.db.get_monthly_totals_for_year(person.user_id, year, to_month):
+            totals_by_month[total.month].append(total)
+
+        summary = self._summarise([total for totals in totals_by_month.values() for total in totals])
+        summary["year"] = year
+        summary["months"] = dict(
+            ("%04d-%02d" % (year, month), self._summarise(totals_by_month[month])) for month in range(1, to_month + 1)
+        )
+        return summary
+
+    def get_expenses_for_month(self, person, year, month, detail=True, by_category=True, columnar=False):
+        # Totals come from the monthly rollup, individual expenses are only loaded when asked for
+        totals = self.db.get_monthly_totals(person.user_id, year, month)
+        expenses_by_group = None
+        if detail and by_category:
+            first_day, last_day = self._range_for_month(year, month)
+            expenses_by_group = self._get_expenses_by_group(person, first_day, last_day, columnar)
+        return self._summarise(totals, expenses_by_group, by_category=by_category)
+
+    def get_expenses_for_this_month(self, person, detail=True, by_category=True, columnar=False):
         now = datetime.now()
-        return self.get_expenses_for_month(person, now.year, now.month)
+        return self.get_expenses_for_month(
+            person, now.year, now.month, detail=detail, by_category=by_category, columnar=columnar
+        )
+
+    def get_expenses_for_category(self, person, year, month, group, parent_category, child_category,
+                                  columnar=False):
+        """Expenses for a single group and category in a month, for expanding one row of the month summary"""
+        first_day, last_day = self._range_for_month(year, month)
+        rows = self.db.get_expense_rows_between(
+            person.user_id, first_day, last_day, EXPENSE_FIELDS,
+            group=group, parent_category=parent_category, child_category=child_category
+        )
+        return {
+            "name": self._friendly_name("{}/{}".format(parent_category, child_category)),
+            "group": group,
+            "parent_category": parent_category,
+            "child_category": child_category,
+            "total_sum": round(sum(row.cost for row in rows), 2),
+            "expenses": serialise_expense_rows(rows, columnar)
+        }
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+DEFAULT_CACHE_SIZE = 256
+
+
+class LRUCache(object):
+    """Thread-safe mapping holding at most max_size entries, evicting the least recently used"""
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedAggregator(object):
+    """Aggregator keeping month results in memory until the user's data version in the database changes
+
+    The data version is increased in the same transaction as every write to a user's expenses, so results
+    cached by the web process are invalidated by syncs running in another process.
+    """
+
+    def __init__(self, aggregator, db, max_size=DEFAULT_CACHE_SIZE):
+        self.aggregator = aggregator
+        self.db = db
+        self.cache = LRUCache(max_size)
+
+    def __getattr__(self, name):
+        return getattr(self.aggregator, name)
+
+    def get_expenses_for_month(self, person, year, month, detail=True, by_category=True, columnar=False):
+        version = self.db.get_data_version(person.user_id)
+        key = (person.user_id, year, month, detail, by_category, columnar)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        result = self.aggregator.get_expenses_for_month(
+            person, year, month, detail=detail, by_category=by_category, columnar=columnar
+        )
+        self.cache.put(key, (version, result))
+        return result
+
+    def get_expenses_for_this_month(self, person, detail=True, by_category=True, columnar=False):
+        now = datetime.now()
+        return self.get_expenses_for_month(
+            person, now.year, now.month, detail=detail, by_category=by_category, columnar=columnar
+        )
@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+from StringIO import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/csv", "text/html",
+                          "text/css", "application/javascript")
+MANIFEST_FILENAME = "manifest.json"
+FINGERPRINTED_EXTENSIONS = (".css", ".js")
+PRECOMPRESSED_EXTENSIONS = [("br", ".br"), ("gzip", ".gz")]
+
+
+def gzip_compress(data):
+    buffer = StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
+
+
+def _compressors():
+    compressors = []
+    if brotli is not None:
+        compressors.append(("br", brotli.compress))
+    compressors.append(("gzip", gzip_compress))
+    return compressors
+
+
+def negotiate_encoding(accept_encodings, encodings):
+    """Pick the first of encodings accepted by the client, brotli is listed first when it is available"""
+    for encoding in encodings:
+        if accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+def compress_response(response, accept_encodings, min_size=DEFAULT_COMPRESSION_MIN_SIZE):
+    """Compress a buffered response body in place if it is large enough and the client accepts it"""
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    compressors = OrderedDict(_compressors())
+    encoding = negotiate_encoding(accept_encodings, compressors.keys())
+    if encoding is None:
+        return response
+
+    response.set_data(compressors[encoding](data))
+    response.headers["Content-Encoding"] = encoding
+    # The compressed body differs byte for byte, so only a weak validator still holds
+    etag, _ = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def fingerprinted_name(filename, data):
+    name, extension = os.path.splitext(filename)
+    return "%s.%s%s" % (name, hashlib.sha1(data).hexdigest()[:12], extension)
+
+
+def load_manifest(static_folder):
+    """The mapping of asset names to fingerprinted names written by build_static, or None before a build"""
+    try:
+        with open(os.path.join(static_folder, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def build_static(static_folder):
+    """Fingerprint the assets in a static folder, point index.html at them and precompress everything
+
+    Run when building the image, so the web process only ever sends files that already exist on disk.
+    """
+    previous_build = set((load_manifest(static_folder) or {}).values())
+    manifest = {}
+    for filename in sorted(os.listdir(static_folder)):
+        if os.path.splitext(filename)[1] not in FINGERPRINTED_EXTENSIONS or filename in previous_build:
+            continue
+        with open(os.path.join(static_folder, filename), "rb") as f:
+            data = f.read()
+        manifest[filename] = fingerprinted_name(filename, data)
+        with open(os.path.join(static_folder, manifest[filename]), "wb") as f:
+            f.write(data)
+
+    index_path = os.path.join(static_folder, "index.html")
+    with open(index_path, "rb") as f:
+        index = f.read()
+    index = re.sub(
+        r'/static/([\w.-]+)',
+        lambda match: "/static/%s" % manifest.get(match.group(1), match.group(1)),
+        index
+    )
+    with open(index_path, "wb") as f:
+        f.write(index)
+
+    for filename in manifest.values() + ["index.html"]:
+        with open(os.path.join(static_folder, filename), "rb") as f:
+            data = f.read()
+        for encoding, compress in _compressors():
+            with open(os.path.join(static_folder, filename + dict(PRECOMPRESSED_EXTENSIONS)[encoding]), "wb") as f:
+                f.write(compress(data))
+
+    with open(os.path.join(static_folder, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    for name, fingerprinted in sorted(build_static(sys.argv[1]).items()):
+        print "%s -> %s" % (name, fingerprinted)
@@ -1,5 +1,6 @@
 import sys
 from collections import defaultdict
+from datetime import timedelta
 from urlparse import urlparse
 
 
@@ -10,6 +11,17 @@ import boto3
 import oauth2
 
 
+DEFAULT_SPLITWISE_PAGE_SIZE = 200
+DEFAULT_SPLITWISE_CATEGORY_TTL_HOURS = 24
+DEFAULT_SYNC_CONCURRENCY = 4
+DEFAULT_SYNC_OVERLAP_MINUTES = 5
+DEFAULT_SYNC_MIN_INTERVAL_MINUTES = 15
+DEFAULT_SYNC_MAX_INTERVAL_MINUTES = 240
+DEFAULT_SYNC_JITTER = 0.2
+DEFAULT_AGGREGATOR_CACHE_SIZE = 256
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+
+
 class SlackConfig(object):
 
     def __init__(self, slack_config_data):
@@ -78,12 +90,51 @@ class Config(object):
     def get_database_uri(self):
         return self.data["database"]["uri"]
 
+    def get_database_pool_settings(self):
+        return self.data["database"].get("pool", {})
+
     def get_splitwise_consumer(self):
         return oauth2.Consumer(
             self.data["splitwise"]["consumer_key"],
             self.data["splitwise"]["consumer_secret"]
         )
 
+    def get_splitwise_page_size(self):
+        return self.data["splitwise"].get("page_size", DEFAULT_SPLITWISE_PAGE_SIZE)
+
+    def get_splitwise_category_ttl(self):
+        return timedelta(hours=self.data["splitwise"].get("category_ttl_hours", DEFAULT_SPLITWISE_CATEGORY_TTL_HOURS))
+
+    def get_http_settings(self):
+        """Optional connect_timeout, read_timeout and pool_size for the shared HTTP transport"""
+        return self.data.get("http", {})
+
+    def get_aggregator_cache_size(self):
+        return self.data.get("web", {}).get("cache_size", DEFAULT_AGGREGATOR_CACHE_SIZE)
+
+    def get_web_server_settings(self):
+        """Optional threads, connection_limit and channel_timeout for waitress"""
+        return self.data.get("web", {}).get("server", {})
+
+    def get_compression_min_size(self):
+        """Smallest response body in bytes worth compressing"""
+        return self.data.get("web", {}).get("compression_min_size", DEFAULT_COMPRESSION_MIN_SIZE)
+
+    def get_sync_concurrency(self):
+        return self.data.get("sync", {}).get("concurrency", DEFAULT_SYNC_CONCURRENCY)
+
+    def get_sync_overlap(self):
+        return timedelta(minutes=self.data.get("sync", {}).get("overlap_minutes", DEFAULT_SYNC_OVERLAP_MINUTES))
+
+    def get_sync_scheduler_settings(self):
+        """Interval bounds and jitter for the adaptive per person sync schedule"""
+        sync = self.data.get("sync", {})
+        return {
+            "min_interval": timedelta(minutes=sync.get("min_interval_minutes", DEFAULT_SYNC_MIN_INTERVAL_MINUTES)),
+            "max_interval": timedelta(minutes=sync.get("max_interval_minutes", DEFAULT_SYNC_MAX_INTERVAL_MINUTES)),
+            "jitter": sync.get("jitter", DEFAULT_SYNC_JITTER)
+        }
+
     @classmethod
     def _get_groups_for_person(self, person):
         default_group = [group for group in person.get("groups") if group.get("default")][0]["default"]
@@ -1,22 +1,59 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, Date, DateTime
+import hashlib
+import json
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, create_engine, extract, func, inspect, Column, Integer, String, Float, Boolean, Date, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 Base = declarative_base()
 
+# Rows per multi-row statement, keeping bound parameters below SQLite's default limit of 999
+UPSERT_CHUNK_SIZE = 50
+HASH_LOOKUP_CHUNK_SIZE = 500
+
 
 class Database(object):
-    def __init__(self, database_filename, echo=False):
-        self.engine = create_engine(database_filename, echo=echo)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+    def __init__(self, database_filename, echo=False, pool_settings=None):
+        # Pool settings such as pool_size, max_overflow or pool_recycle are passed on to the engine as is
+        self.engine = create_engine(database_filename, echo=echo, **(pool_settings or {}))
+        # Sessions are thread-local, so every worker thread or request gets its own session and connection
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        # Conversion rates by date and from/to currency, each date is loaded at most once
+        self._currency_conversions = {}
+
+    def remove_session(self):
+        """Close the current thread's session and return its connection to the pool"""
+        self.session.remove()
 
     # Create tables
     def create_tables(self):
         Base.metadata.create_all(self.engine)
+        self.migrate()
+
+    def get_schema_version(self):
+        schema_version = self.session.query(SchemaVersion).order_by(SchemaVersion.version.desc()).first()
+        if schema_version is not None:
+            return schema_version.version
+        return 0
+
+    def migrate(self):
+        """Apply any schema migrations not yet recorded in the database"""
+        applied = []
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version <= self.get_schema_version():
+                continue
+            migration(self)
+            self.session.add(SchemaVersion(version=version, applied_at=datetime.utcnow()))
+            self.session.commit()
+            applied.append(version)
+        return applied
 
     def purge_expenses(self):
         nbr_of_purged_expenses = self.session.query(Expense).delete()
+        self.session.query(MonthlyTotal).delete()
+        self._bump_data_versions()
         self.session.commit()
         return nbr_of_purged_expenses
 
@@ -25,7 +62,8 @@ class Database(object):
         self.session.commit()
         return nbr_of_purged_markers
 
-    def add_marker(self, user_id, created_at, success, nbr_of_updates, nbr_of_deletes, nbr_of_conversions, message):
+    def add_marker(self, user_id, created_at, success, nbr_of_updates, nbr_of_deletes, nbr_of_conversions, message,
+                   nbr_of_unchanged=0):
         self.session.add(
             Marker(
                 user_id=user_id,
@@ -34,6 +72,7 @@ class Database(object):
                 nbr_of_updates=nbr_of_updates,
                 nbr_of_deletes=nbr_of_deletes,
                 nbr_of_conversions=nbr_of_conversions,
+                nbr_of_unchanged=nbr_of_unchanged,
                 message=message
             )
         )
@@ -55,12 +94,20 @@ class Database(object):
             return marker.created_at
         return None
 
+    def get_currency_conversion_rates(self, for_date, from_currency):
+        """Get all stored conversion rates from a currency for a date, keyed by the currency converted to"""
+        if for_date not in self._currency_conversions:
+            rates = defaultdict(dict)
+            for currency_conversion in self.session.query(CurrencyConversion).filter_by(for_date=for_date):
+                rates[currency_conversion.from_currency][currency_conversion.to_currency] = currency_conversion.rate
+            if not rates:
+                # Another process may store rates for this date later, so only dates with rates are cached
+                return {}
+            self._currency_conversions[for_date] = rates
+        return self._currency_conversions[for_date].get(from_currency, {})
+
     def get_currency_conversion_rate(self, for_date, from_currency, to_currency):
-        currency_conversion = self.session.query(CurrencyConversion) \
-            .filter_by(for_date=for_date, from_currency=from_currency, to_currency=to_currency) \
-            .first()
-        if currency_conversion is not None:
-            return currency_conversion.rate
+        return self.get_currency_conversion_rates(for_date, from_currency).get(to_currency)
 
     def add_currency_conversion(self, for_date, from_currency, to_currency, rate):
         currency_conversion = CurrencyConversion(
@@ -71,26 +118,281 @@ class Database(object):
         )
         self.session.add(currency_conversion)
         self.session.commit()
+        if for_date in self._currency_conversions:
+            self._currency_conversions[for_date][from_currency][to_currency] = rate
         return currency_conversion
 
+    def add_currency_conversions(self, for_date, from_currency, rates):
+        """Store a whole table of conversion rates from a currency for a date in one write"""
+        if not rates:
+            return 0
+        self.session.execute(CurrencyConversion.__table__.insert().values([
+            dict(for_date=for_date, from_currency=from_currency, to_currency=to_currency, rate=rate)
+            for to_currency, rate in rates.items()
+        ]))
+        self.session.commit()
+        if for_date in self._currency_conversions:
+            self._currency_conversions[for_date][from_currency].update(rates)
+        return len(rates)
+
+    def get_categories(self):
+        return self.session.query(CachedCategory).all()
+
+    def replace_categories(self, categories, fetched_at):
+        """Replace all stored categories in one transaction"""
+        self.session.query(CachedCategory).delete()
+        self.session.add_all([
+            CachedCategory(id=category.id, name=category.name, parent=category.parent, fetched_at=fetched_at)
+            for category in categories
+        ])
+        self.session.commit()
+
     def get_expenses(self, user_id):
         return self.session.query(Expense).filter_by(user_id=user_id).order_by(
-            Expense.created_at.desc()).all()
+            Expense.created_at.desc(), Expense.id).all()
+
+    def iter_expense_rows(self, user_id, columns, batch_size=1000):
+        """Stream a user's expenses as tuples of the given columns, holding at most one batch in memory"""
+        return self.session.query(*[getattr(Expense, column) for column in columns]) \
+            .filter_by(user_id=user_id) \
+            .order_by(Expense.created_at, Expense.id) \
+            .execution_options(stream_results=True) \
+            .yield_per(batch_size)
 
     def get_expenses_between(self, user_id, start_date, end_date):
+        """Get expenses from the start of start_date up to and including all of end_date"""
         return self.session.query(Expense) \
             .filter_by(user_id=user_id) \
-            .filter(Expense.created_at.between(start_date, end_date)) \
+            .filter(Expense.created_at >= start_date) \
+            .filter(Expense.created_at < end_date + timedelta(days=1)) \
+            .order_by(Expense.cost.desc(), Expense.created_at.desc()) \
+            .all()
+
+    def get_expense_rows_between(self, user_id, start_date, end_date, columns, **filters):
+        """Like get_expenses_between, but only the given columns as tuples, without building Expense objects"""
+        return self.session.query(*[getattr(Expense, column) for column in columns]) \
+            .filter_by(user_id=user_id, **filters) \
+            .filter(Expense.created_at >= start_date) \
+            .filter(Expense.created_at < end_date + timedelta(days=1)) \
             .order_by(Expense.cost.desc(), Expense.created_at.desc()) \
             .all()
 
     def delete_expense_by_id(self, expense_id):
-        self.session.query(Expense).filter_by(id=expense_id).delete()
+        self.delete_expenses_by_id([expense_id])
+
+    def delete_expenses_by_id(self, expense_ids, chunk_size=UPSERT_CHUNK_SIZE):
+        """Delete expenses in chunks within a single transaction, along with their share of the monthly totals"""
+        expense_ids = list(expense_ids)
+        if not expense_ids:
+            return 0
+        deltas = defaultdict(lambda: [0.0, 0])
+        deleted = 0
+        for start in range(0, len(expense_ids), chunk_size):
+            chunk = expense_ids[start:start + chunk_size]
+            self._add_monthly_total_deltas(deltas, self._get_rows_by_id(chunk).values(), sign=-1)
+            deleted += self.session.query(Expense).filter(Expense.id.in_(chunk)).delete()
+        if not deleted:
+            # None of the expenses were stored, so cached aggregates stay valid
+            self.session.rollback()
+            return 0
+        self._apply_monthly_total_deltas(deltas)
+        self._bump_data_versions(set(key[0] for key in deltas))
+        self.session.commit()
+        return deleted
+
+    def upsert_expenses(self, expenses, chunk_size=UPSERT_CHUNK_SIZE):
+        """Insert or replace changed expenses using chunked multi-row statements within a single transaction,
+        updating the monthly totals by the difference to any replaced rows, and return how many were written"""
+        table = Expense.__table__
+        rows = OrderedDict()
+        for expense in expenses:
+            row = expense.as_row()
+            row["content_hash"] = Expense.content_hash_of(row)
+            rows[expense.id] = row
+        # Expenses whose content and Splitwise updated_at match the stored ones, e.g. seen again through the sync
+        # overlap window, are left alone
+        stored = self._get_versions_by_id(rows.keys())
+        rows = [row for row in rows.values() if stored.get(row["id"]) != (row["content_hash"], row["updated_at"])]
+        if not rows:
+            return 0
+        deltas = defaultdict(lambda: [0.0, 0])
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            chunk_ids = [row["id"] for row in chunk]
+            self._add_monthly_total_deltas(deltas, self._get_rows_by_id(chunk_ids).values(), sign=-1)
+            self._add_monthly_total_deltas(deltas, chunk, sign=1)
+            self.session.execute(table.delete().where(table.c.id.in_(chunk_ids)))
+            self.session.execute(table.insert().values(chunk))
+        self._apply_monthly_total_deltas(deltas)
+        self._bump_data_versions(set(row["user_id"] for row in rows))
         self.session.commit()
+        return len(rows)
+
+    def _get_versions_by_id(self, expense_ids):
+        """Content hash and updated_at of stored expenses, looked up for a whole batch at once"""
+        versions = {}
+        for start in range(0, len(expense_ids), HASH_LOOKUP_CHUNK_SIZE):
+            rows = self.session.query(Expense.id, Expense.content_hash, Expense.updated_at) \
+                .filter(Expense.id.in_(expense_ids[start:start + HASH_LOOKUP_CHUNK_SIZE]))
+            for expense_id, content_hash, updated_at in rows:
+                versions[expense_id] = (content_hash, updated_at)
+        return versions
+
+    def rebuild_content_hashes(self):
+        """Store the content hash of expenses written before hashes were kept"""
+        table = Expense.__table__
+        rows = self.session.execute(table.select().where(table.c.content_hash.is_(None))).fetchall()
+        hashes = [{"expense_id": row["id"], "content_hash": Expense.content_hash_of(row)} for row in rows]
+        if hashes:
+            self.session.execute(
+                table.update().where(table.c.id == bindparam("expense_id")).values(
+                    content_hash=bindparam("content_hash")
+                ),
+                hashes
+            )
+        self.session.commit()
+        return len(hashes)
+
+    def get_expense_ids_without_updated_at(self, user_id):
+        """Ids of a user's expenses written before Splitwise's updated_at was kept"""
+        return set(
+            expense_id for (expense_id,) in
+            self.session.query(Expense.id).filter_by(user_id=user_id).filter(Expense.updated_at.is_(None))
+        )
+
+    def _get_rows_by_id(self, expense_ids):
+        table = Expense.__table__
+        rows = self.session.execute(table.select().where(table.c.id.in_(expense_ids)))
+        return dict((row["id"], dict(row)) for row in rows)
+
+    @classmethod
+    def _add_monthly_total_deltas(cls, deltas, rows, sign):
+        for row in rows:
+            created_at = row["created_at"]
+            key = (row["user_id"], created_at.year, created_at.month,
+                   row["group"], row["parent_category"], row["child_category"])
+            deltas[key][0] += sign * row["cost"]
+            deltas[key][1] += sign
+
+    def _apply_monthly_total_deltas(self, deltas):
+        for key, (total_delta, count_delta) in deltas.items():
+            if count_delta == 0 and round(total_delta, 2) == 0:
+                continue
+            monthly_total = self.session.query(MonthlyTotal).get(key)
+            if monthly_total is None and count_delta <= 0:
+                # Removing from a total that was never recorded, which rebuild_monthly_totals repairs
+                continue
+            if monthly_total is None:
+                user_id, year, month, group, parent_category, child_category = key
+                monthly_total = MonthlyTotal(
+                    user_id=user_id,
+                    year=year,
+                    month=month,
+                    group=group,
+                    parent_category=parent_category,
+                    child_category=child_category,
+                    total=0.0,
+                    count=0
+                )
+                self.session.add(monthly_total)
+            monthly_total.total = round(monthly_total.total + total_delta, 2)
+            monthly_total.count += count_delta
+            if monthly_total.count <= 0:
+                self.session.delete(monthly_total)
+
+    def get_totals_between(self, user_id, start_date, end_date, by_month=False):
+        """Sum and count expenses per group and category, up to and including all of end_date,
+        optionally also per year and month"""
+        columns = [Expense.group, Expense.parent_category, Expense.child_category]
+        if by_month:
+            columns = [
+                extract('year', Expense.created_at).label("year"),
+                extract('month', Expense.created_at).label("month")
+            ] + columns
+        return self.session.query(*(columns + [
+            func.sum(Expense.cost).label("total"),
+            func.count(Expense.id).label("count")
+        ])) \
+            .filter_by(user_id=user_id) \
+            .filter(Expense.created_at >= start_date) \
+            .filter(Expense.created_at < end_date + timedelta(days=1)) \
+            .group_by(*columns) \
+            .all()
+
+    def get_data_version(self, user_id):
+        """Get the counter that changes whenever a user's expenses change, in this or any other process"""
+        data_version = self.session.query(DataVersion).get(user_id)
+        if data_version is not None:
+            return data_version.version
+        return 0
+
+    def _bump_data_versions(self, user_ids=None):
+        """Increase the data version of the given users, or of all users, as part of the current transaction"""
+        if user_ids is None:
+            self.session.query(DataVersion).update({DataVersion.version: DataVersion.version + 1})
+            return
+        for user_id in user_ids:
+            data_version = self.session.query(DataVersion).get(user_id)
+            if data_version is None:
+                self.session.add(DataVersion(user_id=user_id, version=1))
+            else:
+                data_version.version = DataVersion.version + 1
+
+    def get_sync_schedules(self):
+        return dict((sync_schedule.user_id, sync_schedule) for sync_schedule in self.session.query(SyncSchedule))
+
+    def get_sync_schedule(self, user_id):
+        return self.session.query(SyncSchedule).get(user_id)
+
+    def save_sync_schedule(self, user_id, next_run_at, interval_seconds):
+        self.session.merge(SyncSchedule(user_id=user_id, next_run_at=next_run_at, interval_seconds=interval_seconds))
+        self.session.commit()
+
+    def get_monthly_totals(self, user_id, year, month):
+        return self.session.query(MonthlyTotal) \
+            .filter_by(user_id=user_id, year=year, month=month) \
+            .all()
+
+    def get_monthly_totals_for_year(self, user_id, year, to_month=12):
+        """Monthly totals for the months of a year up to and including to_month"""
+        return self.session.query(MonthlyTotal) \
+            .filter_by(user_id=user_id, year=year) \
+            .filter(MonthlyTotal.month <= to_month) \
+            .all()
+
+    def rebuild_monthly_totals(self, user_id=None):
+        """Recompute the monthly totals from the expenses, repairing any drift"""
+        year = extract('year', Expense.created_at)
+        month = extract('month', Expense.created_at)
+        query = self.session.query(
+            Expense.user_id, year, month, Expense.group, Expense.parent_category, Expense.child_category,
+            func.sum(Expense.cost), func.count(Expense.id)
+        ).group_by(Expense.user_id, year, month, Expense.group, Expense.parent_category, Expense.child_category)
+        purge_query = self.session.query(MonthlyTotal)
+        if user_id is not None:
+            query = query.filter(Expense.user_id == user_id)
+            purge_query = purge_query.filter_by(user_id=user_id)
+
+        monthly_totals = [
+            dict(user_id=row[0], year=int(row[1]), month=int(row[2]), group=row[3], parent_category=row[4],
+                 child_category=row[5], total=round(row[6], 2), count=row[7])
+            for row in query
+        ]
+        purge_query.delete()
+        for start in range(0, len(monthly_totals), UPSERT_CHUNK_SIZE):
+            self.session.execute(
+                MonthlyTotal.__table__.insert().values(monthly_totals[start:start + UPSERT_CHUNK_SIZE])
+            )
+        self._bump_data_versions([user_id] if user_id is not None else None)
+        self.session.commit()
+        return len(monthly_totals)
 
 
 class Expense(Base):
     __tablename__ = 'expenses'
+    __table_args__ = (
+        Index('ix_expenses_user_id_created_at', 'user_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
@@ -103,6 +405,19 @@ class Expense(Base):
     cost = Column(Float)
     original_currency = Column(String)
     currency = Column(String)
+    updated_at = Column(DateTime)
+    content_hash = Column(String(16))
+
+    # Columns describing the expense itself, as opposed to when it was last seen
+    CONTENT_COLUMNS = ("user_id", "group_id", "group", "created_at", "description", "parent_category",
+                       "child_category", "cost", "original_currency", "currency")
+
+    @classmethod
+    def content_hash_of(cls, row):
+        """Compact hash of the content of an expense row, to tell changed expenses from ones already stored"""
+        values = [row[column] for column in cls.CONTENT_COLUMNS]
+        content = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+        return hashlib.sha1(content).hexdigest()[:16]
 
     def __repr__(self):
         return "<Expense(id='%s', user_id='%s', date='%s', description='%s', category='%s/%s', cost='%s %s')>" % (
@@ -113,6 +428,9 @@ class Expense(Base):
     def category(self):
         return "{}/{}".format(self.parent_category, self.child_category)
 
+    def as_row(self):
+        return dict((column.name, getattr(self, column.name)) for column in self.__table__.columns)
+
     def as_dictionary(self):
         return {
             "id": self.id,
@@ -127,6 +445,10 @@ class Expense(Base):
 
 class Marker(Base):
     __tablename__ = 'markers'
+    __table_args__ = (
+        Index('ix_markers_user_id_success_created_at', 'user_id', 'success', 'created_at'),
+        Index('ix_markers_user_id_created_at', 'user_id', 'created_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     created_at = Column(DateTime)
@@ -135,18 +457,22 @@ class Marker(Base):
     nbr_of_updates = Column(Integer)
     nbr_of_deletes = Column(Integer)
     nbr_of_conversions = Column(Integer)
+    nbr_of_unchanged = Column(Integer)
     message = Column(String)
 
     def __repr__(self):
         return """<Marker(id='%s', created_at='%s', user_id='%s',
-        success='%s', deletes='%s', updates='%s', currency_conversions='%s', message='%s')>""" % (
+        success='%s', deletes='%s', updates='%s', unchanged='%s', currency_conversions='%s', message='%s')>""" % (
             self.id, self.created_at, self.user_id, self.success, self.nbr_of_deletes, self.nbr_of_updates,
-            self.nbr_of_conversions, self.message
+            self.nbr_of_unchanged, self.nbr_of_conversions, self.message
         )
 
 
 class CurrencyConversion(Base):
     __tablename__ = 'currency_conversions'
+    __table_args__ = (
+        Index('ix_currency_conversions_for_date_from_currency_to_currency', 'for_date', 'from_currency', 'to_currency'),
+    )
 
     id = Column(Integer, primary_key=True)
     for_date = Column(Date)
@@ -157,3 +483,101 @@ class CurrencyConversion(Base):
     def __repr__(self):
         return "<CurrencyConversion(id='%s', for_date='%s', from_currency='%s', to_currency='%s', rate='%s')>" % (
             self.id, self.for_date, self.from_currency, self.to_currency, self.rate)
+
+
+class CachedCategory(Base):
+    __tablename__ = 'categories'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    parent = Column(String)
+    fetched_at = Column(DateTime)
+
+    def __repr__(self):
+        return "<CachedCategory(id='%s', name='%s', parent='%s', fetched_at='%s')>" % (
+            self.id, self.name, self.parent, self.fetched_at)
+
+
+class MonthlyTotal(Base):
+    __tablename__ = 'monthly_totals'
+
+    user_id = Column(Integer, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    group = Column(String, primary_key=True)
+    parent_category = Column(String, primary_key=True)
+    child_category = Column(String, primary_key=True)
+    total = Column(Float)
+    count = Column(Integer)
+
+    def __repr__(self):
+        return "<MonthlyTotal(user_id='%s', month='%s-%s', group='%s', category='%s/%s', total='%s', count='%s')>" % (
+            self.user_id, self.year, self.month, self.group, self.parent_category, self.child_category,
+            self.total, self.count)
+
+    @property
+    def category(self):
+        return "{}/{}".format(self.parent_category, self.child_category)
+
+
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+
+    user_id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+
+    def __repr__(self):
+        return "<DataVersion(user_id='%s', version='%s')>" % (self.user_id, self.version)
+
+
+class SyncSchedule(Base):
+    __tablename__ = 'sync_schedules'
+
+    user_id = Column(Integer, primary_key=True)
+    next_run_at = Column(DateTime)
+    interval_seconds = Column(Integer)
+
+    def __repr__(self):
+        return "<SyncSchedule(user_id='%s', next_run_at='%s', interval_seconds='%s')>" % (
+            self.user_id, self.next_run_at, self.interval_seconds)
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(DateTime)
+
+    def __repr__(self):
+        return "<SchemaVersion(version='%s', applied_at='%s')>" % (self.version, self.applied_at)
+
+
+def _create_missing_indexes(engine, *tables):
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def _add_missing_columns(engine, *tables):
+    """Add columns introduced after a table was created, which are all nullable"""
+    preparer = engine.dialect.identifier_preparer
+    inspector = inspect(engine)
+    for table in tables:
+        existing = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    preparer.format_table(table), preparer.format_column(column),
+                    column.type.compile(dialect=engine.dialect)
+                ))
+
+
+# Migrations for databases created before a schema change; each step must be safe to run on a fresh database
+MIGRATIONS = [
+    lambda db: _create_missing_indexes(
+        db.engine, Expense.__table__, Marker.__table__, CurrencyConversion.__table__
+    ),
+    lambda db: db.rebuild_monthly_totals(),
+    lambda db: _add_missing_columns(db.engine, Expense.__table__, Marker.__table__),
+    lambda db: db.rebuild_content_hashes(),
+]
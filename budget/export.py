@@ -0,0 +1,59 @@
+import csv
+import json
+from collections import OrderedDict
+from StringIO import StringIO
+
+
+EXPORT_COLUMNS = [
+    "id",
+    "user_id",
+    "group_id",
+    "group",
+    "created_at",
+    "description",
+    "parent_category",
+    "child_category",
+    "cost",
+    "currency",
+    "original_currency"
+]
+
+
+def _format_row(row):
+    values = list(row)
+    values[EXPORT_COLUMNS.index("created_at")] = row.created_at.isoformat()
+    values[EXPORT_COLUMNS.index("cost")] = '%.2f' % row.cost
+    return values
+
+
+def iter_ndjson(rows):
+    """Serialise rows as newline delimited JSON, one line at a time"""
+    for row in rows:
+        yield json.dumps(OrderedDict(zip(EXPORT_COLUMNS, _format_row(row)))) + "\n"
+
+
+def iter_csv(rows):
+    """Serialise rows as CSV with a header, one line at a time"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writerow(EXPORT_COLUMNS)
+    yield flush()
+    for row in rows:
+        writer.writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value for value in _format_row(row)
+        ])
+        yield flush()
+
+
+# Serialiser and content type for each export format
+EXPORT_FORMATS = {
+    "ndjson": (iter_ndjson, "application/x-ndjson"),
+    "csv": (iter_csv, "text/csv")
+}
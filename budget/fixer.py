@@ -1,6 +1,14 @@
 import json
+import threading
 import time
-import urllib2
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from transport import Transport
+
+
+# Upper bound on concurrent requests to the API when prefetching rate tables
+DEFAULT_MAX_WORKERS = 4
 
 
 class FixerException(Exception):
@@ -9,8 +17,16 @@ class FixerException(Exception):
 
 class Fixer(object):
 
-    def __init__(self):
+    def __init__(self, db=None, max_workers=DEFAULT_MAX_WORKERS, transport=None):
         self.base_url = "http://api.fixer.io/"
+        self.db = db
+        self.transport = transport if transport is not None else Transport()
+        self.max_workers = max_workers
+        self._rates = {}
+        # Futures for the dates being fetched, so people synced in parallel never fetch the same date twice
+        self._in_flight = {}
+        # Only guards the two maps above, never held while fetching or storing
+        self.lock = threading.Lock()
         self.known_currencies = {
             u'USD',
             u'IDR',
@@ -45,13 +61,10 @@ class Fixer(object):
             u'ZAR'
         }
 
-    @classmethod
     def _request(self, url):
         """Retrieve from API"""
         try:
-            req = urllib2.Request(url=url)
-            f = urllib2.urlopen(req)
-            return f.read()
+            return self.transport.request(url)
         except Exception as e:
             raise FixerException("Could not convert currency, url=%s: %s" % (url, e))
 
@@ -64,6 +77,105 @@ class Fixer(object):
     def _validate_currency(self, currency):
         return currency == 'EUR' or currency in self.known_currencies
 
+    def _fetch_rates(self, for_date):
+        """Retrieve the EUR based rate table for a date"""
+        exchange_rates = self._conversionsForDate(for_date)
+        rates = dict((currency, float(rate)) for currency, rate in exchange_rates['rates'].items())
+        rates['EUR'] = 1.0
+        return rates
+
+    def _get_stored_rates(self, for_date):
+        """The stored EUR based rate table for a date, or None unless it is complete
+
+        Tables are stored whole including the EUR to EUR row, single pairs stored before that are not enough.
+        """
+        if self.db is None:
+            return None
+        rates = self.db.get_currency_conversion_rates(for_date, 'EUR')
+        return rates if 'EUR' in rates else None
+
+    def _store_rates(self, for_date, rates):
+        if self.db is not None:
+            stored_rates = self.db.get_currency_conversion_rates(for_date, 'EUR')
+            self.db.add_currency_conversions(for_date, 'EUR', dict(
+                (currency, rate) for currency, rate in rates.items() if currency not in stored_rates
+            ))
+
+    def _claim_dates(self, dates):
+        """Split dates without known rates into futures the caller must resolve and ones another thread resolves"""
+        with self.lock:
+            claimed, in_flight = {}, {}
+            for for_date in dates:
+                if for_date in self._rates:
+                    continue
+                if for_date in self._in_flight:
+                    in_flight[for_date] = self._in_flight[for_date]
+                else:
+                    claimed[for_date] = self._in_flight[for_date] = Future()
+            return claimed, in_flight
+
+    def _resolve(self, for_date, future, rates=None, exception=None):
+        with self.lock:
+            if exception is None:
+                self._rates[for_date] = rates
+            del self._in_flight[for_date]
+        if exception is None:
+            future.set_result(rates)
+        else:
+            future.set_exception(exception)
+
+    def get_rates_for_date(self, for_date):
+        """Get the EUR based rate table for a date, fetching and storing it at most once"""
+        claimed, in_flight = self._claim_dates([for_date])
+        if for_date in in_flight:
+            return in_flight[for_date].result()
+        if for_date not in claimed:
+            return self._rates[for_date]
+
+        try:
+            rates = self._get_stored_rates(for_date)
+            if rates is None:
+                rates = self._fetch_rates(for_date)
+                self._store_rates(for_date, rates)
+        except Exception as e:
+            self._resolve(for_date, claimed[for_date], exception=e)
+            raise
+        self._resolve(for_date, claimed[for_date], rates)
+        return rates
+
+    def prefetch_rates(self, dates):
+        """Fetch the rate tables for all dates not seen before concurrently, then store them
+
+        Dates already being fetched by another thread are left to it, get_rates_for_date waits for those.
+        """
+        claimed, _ = self._claim_dates(set(dates))
+        missing_dates = []
+        try:
+            for for_date in sorted(claimed):
+                rates = self._get_stored_rates(for_date)
+                if rates is None:
+                    missing_dates.append(for_date)
+                else:
+                    self._resolve(for_date, claimed[for_date], rates)
+            if missing_dates:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing_dates))) as executor:
+                    # Only the requests run concurrently, storing happens on the calling thread
+                    for for_date, rates in zip(missing_dates, executor.map(self._fetch_rates, missing_dates)):
+                        self._store_rates(for_date, rates)
+                        self._resolve(for_date, claimed[for_date], rates)
+        except Exception as e:
+            # Dates left unresolved must not keep other threads waiting
+            for for_date, future in claimed.items():
+                if not future.done():
+                    self._resolve(for_date, future, exception=e)
+            raise
+        return len(missing_dates)
+
+    @classmethod
+    def cross_rate(cls, rates, from_currency, to_currency):
+        """Derive the conversion rate between two currencies from an EUR based rate table"""
+        return round(rates[to_currency] / rates[from_currency], 2)
+
     def get_conversion_rate(self, for_date, from_currency, to_currency):
         """Convert from one currency to the other, at a specific point in time, if necessary"""
         for currency in [from_currency, to_currency]:
@@ -73,14 +185,4 @@ class Fixer(object):
         if from_currency == to_currency:
             return 1.0
 
-        exchange_rates = self._conversionsForDate(for_date)
-
-        # Since EUR is the base currency, we need to do this slightly different for any EUR requests
-        if from_currency == 'EUR':
-            conversion_rate = float(exchange_rates['rates'][to_currency])
-        else:
-            previous_currency_rate = float(exchange_rates['rates'][from_currency])
-            new_currency_rate = float(exchange_rates['rates'][to_currency])
-            conversion_rate = new_currency_rate/previous_currency_rate
-
-        return round(conversion_rate, 2)
\ No newline at end of file
+        return self.cross_rate(self.get_rates_for_date(for_date), from_currency, to_currency)
@@ -0,0 +1,55 @@
+import random
+from datetime import datetime, timedelta
+
+
+DEFAULT_MIN_INTERVAL = timedelta(minutes=15)
+DEFAULT_MAX_INTERVAL = timedelta(hours=4)
+DEFAULT_JITTER = 0.2
+
+
+class AdaptiveScheduler(object):
+    """Keeps a next sync time for each person, backing off while their syncs find nothing new
+
+    The interval doubles after every sync without changes, up to max_interval, and drops back to min_interval as
+    soon as a sync finds changes or fails. Each run is moved by up to the jitter fraction of the interval either
+    way, so people drift apart instead of all hitting Splitwise at once. State is kept in the database.
+    """
+
+    def __init__(self, db, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 jitter=DEFAULT_JITTER, random_source=None):
+        self.db = db
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.random = random_source or random.Random()
+
+    def next_interval(self, interval, changed):
+        if changed or interval is None:
+            return self.min_interval
+        return min(interval * 2, self.max_interval)
+
+    def longest_interval(self):
+        """The longest a person can go between two syncs that run on schedule"""
+        return timedelta(seconds=self.max_interval.total_seconds() * (1 + self.jitter))
+
+    def _jittered(self, interval):
+        return timedelta(seconds=interval.total_seconds() * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def record(self, user_id, changed, now=None):
+        """Schedule the next sync for a person after one has finished, returning when it is due"""
+        now = now or datetime.utcnow()
+        sync_schedule = self.db.get_sync_schedule(user_id)
+        previous_interval = timedelta(seconds=sync_schedule.interval_seconds) if sync_schedule is not None else None
+        interval = self.next_interval(previous_interval, changed)
+        next_run_at = now + self._jittered(interval)
+        self.db.save_sync_schedule(user_id, next_run_at, int(interval.total_seconds()))
+        return next_run_at
+
+    def due(self, people, now=None):
+        """People whose next sync is due, including anyone not synced before"""
+        now = now or datetime.utcnow()
+        sync_schedules = self.db.get_sync_schedules()
+        return [
+            person for person in people
+            if person.user_id not in sync_schedules or sync_schedules[person.user_id].next_run_at <= now
+        ]
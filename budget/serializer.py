@@ -0,0 +1,30 @@
+import json
+
+
+# Fields of an expense in API responses, and the columns queried for them
+EXPENSE_FIELDS = ["id", "created_at", "description", "group", "parent_category", "child_category", "cost"]
+_CREATED_AT = EXPENSE_FIELDS.index("created_at")
+_COST = EXPENSE_FIELDS.index("cost")
+
+
+def _format_columns(rows):
+    """Transpose expense rows into one list per field, formatting dates and amounts a whole column at a time"""
+    if not rows:
+        return [[] for _ in EXPENSE_FIELDS]
+    columns = [list(column) for column in zip(*rows)]
+    columns[_CREATED_AT] = [created_at.isoformat()[:10] for created_at in columns[_CREATED_AT]]
+    columns[_COST] = ['%.2f' % cost for cost in columns[_COST]]
+    return columns
+
+
+def serialise_expense_rows(rows, columnar=False):
+    """Expenses as dictionaries matching Expense.as_dictionary, or as parallel lists keyed by field"""
+    columns = _format_columns(rows)
+    if columnar:
+        return dict(zip(EXPENSE_FIELDS, columns))
+    return [dict(zip(EXPENSE_FIELDS, values)) for values in zip(*columns)]
+
+
+def dumps(data):
+    """Encode compact JSON in a single pass of the C encoder, which sorted keys or indentation would rule out"""
+    return json.dumps(data, separators=(",", ":"))
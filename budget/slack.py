@@ -14,7 +14,7 @@ class Slack(object):
 
     def notify(self, last_marker, person):
         currency = person.default_currency
-        summary = self.aggregator.get_expenses_for_this_month(person)
+        summary = self.aggregator.get_expenses_for_this_month(person, detail=False)
         sync_status = "successful :heavy_check_mark:" if last_marker.success else "failed :("
         text = [
             "*{}*".format(person.name),
@@ -1,27 +1,84 @@
 import json
+import threading
 import urllib
 from collections import namedtuple
 from datetime import datetime, timedelta
 
 import dateutil.parser
-import oauth2
+import pytz
+from requests_oauthlib import OAuth1
 
 from database import Expense
+from transport import Transport
 
 Expenses = namedtuple("Expenses", ["new", "deleted"])
 Category = namedtuple("Category", ["id", "name", "parent"])
 
+DEFAULT_CATEGORY_TTL = timedelta(hours=24)
+# Unknown category IDs force a refresh, but never more often than this
+MIN_CATEGORY_REFRESH_INTERVAL = timedelta(minutes=1)
+
+
+class CategoryCache(object):
+    """Splitwise categories shared by all clients, kept in memory and optionally in the database"""
+
+    def __init__(self, db=None, ttl=DEFAULT_CATEGORY_TTL):
+        self.db = db
+        self.ttl = ttl
+        self.categories = None
+        self.fetched_at = None
+        self.lock = threading.Lock()
+
+    def _is_fresh(self, now):
+        return self.fetched_at is not None and now - self.fetched_at < self.ttl
+
+    def _load(self):
+        """Load categories persisted by a previous run"""
+        cached_categories = self.db.get_categories()
+        if cached_categories:
+            self.categories = dict(
+                (c.id, Category(c.id, c.name, c.parent)) for c in cached_categories
+            )
+            self.fetched_at = min(c.fetched_at for c in cached_categories)
+
+    def _fetch(self, fetch_categories, now):
+        self.categories = fetch_categories()
+        self.fetched_at = now
+        if self.db is not None:
+            self.db.replace_categories(self.categories.values(), fetched_at=now)
+
+    def get(self, fetch_categories):
+        """Get categories, fetching them if they are missing or older than the TTL"""
+        with self.lock:
+            now = datetime.utcnow()
+            if self.categories is None and self.db is not None:
+                self._load()
+            if not self._is_fresh(now):
+                self._fetch(fetch_categories, now)
+            return self.categories
+
+    def refresh(self, fetch_categories):
+        """Fetch categories regardless of the TTL, for when an unknown category is encountered"""
+        with self.lock:
+            now = datetime.utcnow()
+            if self.fetched_at is None or now - self.fetched_at >= MIN_CATEGORY_REFRESH_INTERVAL:
+                self._fetch(fetch_categories, now)
+            return self.categories
+
 
 class Splitwise(object):
 
-    def __init__(self, consumer, person):
+    def __init__(self, consumer, person, page_size=None, category_cache=None, transport=None):
         self.base_url = 'https://secure.splitwise.com/api/v3.0'
-        self.client = oauth2.Client(consumer, person.token)
+        self.auth = OAuth1(consumer.key, consumer.secret, person.token.key, person.token.secret)
+        self.transport = transport if transport is not None else Transport()
         self.person = person
+        self.page_size = page_size
+        self.category_cache = category_cache
 
     def request(self, url, method ="GET"):
         """Make HTTP request and deserialise the JSON response"""
-        resp, content = self.client.request(url, method)
+        content = self.transport.request(url, method, auth=self.auth)
         return json.loads(content)
 
     def _build_url(self, path, query = None):
@@ -73,15 +130,21 @@ class Splitwise(object):
         """Construct unique expense ID"""
         return int("".join([str(self.person.user_id), str(expense.get("id"))]))
 
-    def get_expenses(self, updated_after=None):
-        """Get all expenses"""
-        url_parameters = {"limit": "0"}
+    @classmethod
+    def _get_expenses_parameters(cls, updated_after, dated_after=None, dated_before=None):
         if updated_after is not None and isinstance(updated_after, datetime):
-            url_parameters = {"updated_after" : updated_after.date().isoformat()}
-
-        categories = self.get_categories()
-
-        raw_expenses = self.request(self._build_url("get_expenses", url_parameters)).get("expenses")
+            if updated_after.tzinfo is not None:
+                updated_after = updated_after.astimezone(pytz.utc).replace(tzinfo=None)
+            return {"updated_after": updated_after.strftime("%Y-%m-%dT%H:%M:%SZ")}
+        parameters = {"limit": "0"}
+        if dated_after is not None:
+            parameters["dated_after"] = dated_after.isoformat()
+        if dated_before is not None:
+            parameters["dated_before"] = dated_before.isoformat()
+        return parameters
+
+    def _parse_expenses(self, raw_expenses, categories):
+        """Turn raw expenses into new and deleted expenses applicable to the user"""
         new_expenses = []
 
         deleted_expenses = []
@@ -91,13 +154,14 @@ class Splitwise(object):
             user_id = int(self.person.user_id)
             created_at = self._parse_date(e.get("date"))
             description = e.get("description").strip()
-            category = categories.get(e.get("category").get("id"))
+            category = self._get_category(categories, e.get("category").get("id"))
             parent_category = category.parent
             child_category = category.name
             user_share = self._get_user_share(e)
             group_id = self._get_group_id(e)
             group = self.person.groups[group_id]
             currency = e.get("currency_code")
+            updated_at = self._parse_date(e.get("updated_at")) if e.get("updated_at") else None
 
             #  Handle erroneous date time offsets recurring expenses
             if self._does_repeat(e):
@@ -114,7 +178,8 @@ class Splitwise(object):
                 child_category=child_category,
                 cost=user_share,
                 currency=currency,
-                original_currency=currency
+                original_currency=currency,
+                updated_at=updated_at
             )
 
             new_expenses.append(expense)
@@ -125,6 +190,44 @@ class Splitwise(object):
 
         return Expenses(new=new_expenses, deleted=deleted_expenses)
 
+    def get_expense_pages(self, updated_after=None, dated_after=None, dated_before=None):
+        """Get expenses one page at a time, or all at once if no page size is set"""
+        categories = self._get_categories()
+        offset = 0
+
+        while True:
+            url_parameters = self._get_expenses_parameters(updated_after, dated_after, dated_before)
+            if self.page_size:
+                url_parameters.update({"limit": str(self.page_size), "offset": str(offset)})
+
+            raw_expenses = self.request(self._build_url("get_expenses", url_parameters)).get("expenses")
+            yield self._parse_expenses(raw_expenses, categories)
+
+            if not self.page_size or len(raw_expenses) < self.page_size:
+                return
+            offset += len(raw_expenses)
+
+    def get_expenses(self, updated_after=None):
+        """Get all expenses"""
+        new_expenses = []
+        deleted_expenses = []
+        for expenses in self.get_expense_pages(updated_after):
+            new_expenses.extend(expenses.new)
+            deleted_expenses.extend(expenses.deleted)
+        return Expenses(new=new_expenses, deleted=deleted_expenses)
+
+    def _get_categories(self):
+        if self.category_cache is None:
+            return self.get_categories()
+        return self.category_cache.get(self.get_categories)
+
+    def _get_category(self, categories, category_id):
+        category = categories.get(category_id)
+        if category is None and self.category_cache is not None:
+            # An unknown category means the cached categories are out of date
+            category = self.category_cache.refresh(self.get_categories).get(category_id)
+        return category
+
     def get_categories(self):
         """Get all categories"""
         categories = {}
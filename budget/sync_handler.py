@@ -1,30 +1,56 @@
+import calendar
 import datetime
+import hashlib
 import os
 import sys
+from collections import defaultdict
 
 
 import pytz
 
 
+DEFAULT_SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+
 class SyncHandler(object):
 
-    def __init__(self, db, person, splitwise, fixer):
+    def __init__(self, db, person, splitwise, fixer, overlap=DEFAULT_SYNC_OVERLAP):
         self.db = db
         self.person = person
         self.splitwise = splitwise
         self.fixer = fixer
+        self.overlap = overlap
 
         self.nbr_of_updates = 0
+        self.nbr_of_unchanged = 0
         self.nbr_of_deletes = 0
         self.nbr_of_conversions = 0
 
     def _reset_counters(self):
         self.nbr_of_updates = 0
+        self.nbr_of_unchanged = 0
         self.nbr_of_deletes = 0
         self.nbr_of_conversions = 0
 
+    def _needs_currency_conversion(self, expense):
+        return expense.currency != self.person.default_currency
+
+    def _prefetch_currency_conversions(self, expenses):
+        """Fetch the rate tables for every date needing conversion up front, rather than one by one while writing"""
+        dates = set()
+        for expense in filter(self._needs_currency_conversion, expenses):
+            for_date = expense.created_at.date()
+            rate = self.db.get_currency_conversion_rate(
+                for_date=for_date,
+                from_currency=expense.original_currency,
+                to_currency=self.person.default_currency
+            )
+            if rate is None:
+                dates.add(for_date)
+        return self.fixer.prefetch_rates(dates)
+
     def _handle_currency_conversion(self, expense):
-        if expense.currency != self.person.default_currency:
+        if self._needs_currency_conversion(expense):
             for_date = expense.created_at.date()
             from_currency = expense.original_currency
             to_currency = self.person.default_currency
@@ -34,17 +60,15 @@ class SyncHandler(object):
                 to_currency=to_currency
             )
             if rate is None:
+                # The daily rate table is stored by the Fixer, so further pairs for this date are derived locally
                 rate = self.fixer.get_conversion_rate(
                     for_date=for_date,
                     from_currency=from_currency,
                     to_currency=to_currency
                 )
-                self.db.add_currency_conversion(
-                    for_date=for_date,
-                    from_currency=from_currency,
-                    to_currency=to_currency,
-                    rate=rate
-                )
+            else:
+                # Stored EUR based rates are unrounded, match the precision of derived rates
+                rate = round(rate, 2)
             expense.cost = round(expense.cost * rate, 2)
             expense.currency = to_currency
             self.nbr_of_conversions += 1
@@ -52,22 +76,101 @@ class SyncHandler(object):
         else:
             return expense
 
+    def _write_expenses(self, new_expenses, deleted_expense_ids):
+        self._prefetch_currency_conversions(new_expenses)
+        new_expenses = [self._handle_currency_conversion(new_expense) for new_expense in new_expenses]
+        nbr_of_updates = self.db.upsert_expenses(new_expenses)
+        self.nbr_of_updates += nbr_of_updates
+        self.nbr_of_unchanged += len(new_expenses) - nbr_of_updates
+        # Deletions count as reported by Splitwise, even when the expense was never stored or is already gone
+        self.db.delete_expenses_by_id(deleted_expense_ids)
+        self.nbr_of_deletes += len(deleted_expense_ids)
+
+    def _sync_updates(self):
+        time_previous_sync = self.db.get_last_successful_marker_datetime(self.person.user_id)
+
+        # Markers are stored as UTC, reach back a little further to allow for clock skew between us and Splitwise
+        updated_after = time_previous_sync - self.overlap if time_previous_sync is not None else None
+
+        for expenses in self.splitwise.get_expense_pages(updated_after):
+            self._write_expenses(expenses.new, expenses.deleted)
+
+    @staticmethod
+    def _add_to_month_digests(digests, rows):
+        """Count and order independent checksum of expense ids and Splitwise update times, per month"""
+        for expense_id, created_at, updated_at in rows:
+            digest = digests[(created_at.year, created_at.month)]
+            row_hash = hashlib.sha1("%s:%s" % (expense_id, updated_at.isoformat() if updated_at else "")).hexdigest()
+            digest[0] += 1
+            digest[1] ^= int(row_hash[:16], 16)
+        return digests
+
+    def _repair_month(self, year, month):
+        """Replace the stored expenses for a month with the ones Splitwise has for it"""
+        _, last_day = calendar.monthrange(year, month)
+        first_day, last_day = datetime.date(year, month, 1), datetime.date(year, month, last_day)
+
+        # Recurring expenses are moved by an hour when parsed, so fetch a day either side and filter afterwards
+        new_expenses = []
+        for expenses in self.splitwise.get_expense_pages(
+                dated_after=first_day - datetime.timedelta(days=1),
+                dated_before=last_day + datetime.timedelta(days=1)):
+            new_expenses.extend(
+                expense for expense in expenses.new
+                if (expense.created_at.year, expense.created_at.month) == (year, month)
+            )
+
+        new_expense_ids = set(expense.id for expense in new_expenses)
+        stored_expense_ids = [
+            row.id for row in self.db.get_expense_rows_between(self.person.user_id, first_day, last_day, ["id"])
+        ]
+        self._write_expenses(new_expenses, [id for id in stored_expense_ids if id not in new_expense_ids])
+
+    def _reconcile(self):
+        # Expenses stored before updated_at was kept can't be compared by it, so they are rewritten from the listing
+        # once, which also corrects any drift in them as the weekly purge and resync used to
+        legacy_expense_ids = self.db.get_expense_ids_without_updated_at(self.person.user_id)
+        legacy_expenses = []
+        remote_digests = defaultdict(lambda: [0, 0])
+        for expenses in self.splitwise.get_expense_pages():
+            self._add_to_month_digests(
+                remote_digests, [(expense.id, expense.created_at, expense.updated_at) for expense in expenses.new]
+            )
+            legacy_expenses.extend(expense for expense in expenses.new if expense.id in legacy_expense_ids)
+        self._write_expenses(legacy_expenses, [])
+        local_digests = self._add_to_month_digests(
+            defaultdict(lambda: [0, 0]),
+            self.db.iter_expense_rows(self.person.user_id, ["id", "created_at", "updated_at"])
+        )
+
+        months = sorted(
+            month for month in set(remote_digests) | set(local_digests)
+            if remote_digests.get(month) != local_digests.get(month)
+        )
+        for year, month in months:
+            self._repair_month(year, month)
+        return months
+
     def execute(self, sentry_client=None):
+        """Sync the expenses updated since the last successful sync"""
+        self._run(self._sync_updates, sentry_client)
+
+    def reconcile(self, sentry_client=None):
+        """Compare each month's stored expenses with Splitwise, re-fetching and repairing only months that differ
+
+        Stored costs are converted, so months are compared by expense ids and Splitwise's updated_at instead,
+        which changes along with the cost. Returns the repaired months, or None if reconciliation failed.
+        """
+        return self._run(self._reconcile, sentry_client)
+
+    def _run(self, work, sentry_client=None):
         self._reset_counters()
 
-        time_previous_sync = self.db.get_last_successful_marker_datetime(self.person.user_id)
         time_now = datetime.datetime.now(tz=pytz.utc)
 
+        result = None
         try:
-            expenses = self.splitwise.get_expenses(time_previous_sync)
-            for new_expense in expenses.new:
-                new_expense = self._handle_currency_conversion(new_expense)
-                self.db.session.merge(new_expense)
-                self.nbr_of_updates += 1
-                self.db.session.commit()
-            for deleted_expense_id in expenses.deleted:
-                self.db.delete_expense_by_id(expense_id=deleted_expense_id)
-                self.nbr_of_deletes += 1
+            result = work()
         except Exception as e:
             if sentry_client:
                 sentry_client.captureException()
@@ -84,7 +187,8 @@ class SyncHandler(object):
                 nbr_of_updates=self.nbr_of_updates,
                 nbr_of_deletes=self.nbr_of_deletes,
                 nbr_of_conversions=self.nbr_of_conversions,
-                message=message
+                message=message,
+                nbr_of_unchanged=self.nbr_of_unchanged
             )
         else:
             self.db.add_marker(
@@ -94,5 +198,7 @@ class SyncHandler(object):
                 nbr_of_updates=self.nbr_of_updates,
                 nbr_of_deletes=self.nbr_of_deletes,
                 nbr_of_conversions=self.nbr_of_conversions,
-                message=None
-            )
\ No newline at end of file
+                message=None,
+                nbr_of_unchanged=self.nbr_of_unchanged
+            )
+        return result
\ No newline at end of file
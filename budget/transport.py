@@ -0,0 +1,28 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 10
+
+
+class Transport(object):
+    """HTTP transport shared by the API clients, keeping connections alive and asking for compressed responses"""
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+        # One pool of keep-alive connections per host, large enough for all sync workers
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, url, method="GET", auth=None):
+        """Make HTTP request and return the (decompressed) response body"""
+        response = self.session.request(method, url, auth=auth, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
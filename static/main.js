@@ -6,12 +6,36 @@ function selectMonth() {
     return null;
 }
 
+function loadCategoryExpenses(target, yearAndMonthParameter) {
+    // Expenses are only fetched the first time a category is expanded
+    if (target.data('loaded')) {
+        return;
+    }
+    target.data('loaded', true);
+    $.ajax({
+        url: "/api/v1.0/expenses/" + yearAndMonthParameter + "/category",
+        data: {
+            group: target.data('group'),
+            parent_category: target.data('parent-category'),
+            child_category: target.data('child-category')
+        },
+        success: function(response) {
+            var renderCategoryExpenses = Handlebars.compile($('#category-expenses-template').html());
+            target.find('tbody').html(renderCategoryExpenses(response));
+        },
+        error: function() {
+            target.data('loaded', false);
+        }
+    });
+}
+
 $(function() {
     var yearAndMonth = selectMonth();
     var yearAndMonthParameter = yearAndMonth == null ? "this_month" : yearAndMonth;
     var url = "/api/v1.0/expenses/" + yearAndMonthParameter;
     $.ajax({
         url: url,
+        data: {detail: "category"},
         success: function(response) {
             var renderSummary = Handlebars.compile($('#summary-template').html());
             $('#main').append(
@@ -39,6 +63,7 @@ $(function() {
 
     $('#main').on('show.bs.collapse', function(event) {
             $('#' + event.target.id + "__expand").addClass('glyphicon-chevron-up').removeClass('glyphicon-chevron-down');
+            loadCategoryExpenses($(event.target), yearAndMonthParameter);
     });
 
     $('#main').on('hidden.bs.collapse', function(event) {
@@ -1,26 +1,38 @@
 import argparse
+import itertools
 import logging
 import sys
+import threading
 import time
+from collections import Counter
+from datetime import datetime, timedelta
 
 
 from budget.aggregator import Aggregator
 from budget.config import Config
 from budget.database import *
+from budget.export import EXPORT_COLUMNS, EXPORT_FORMATS
 from budget.fixer import Fixer
+from budget.scheduler import AdaptiveScheduler
 from budget.slack import Slack
-from budget.splitwise import Splitwise
+from budget.splitwise import CategoryCache, Splitwise
 from budget.sync_handler import SyncHandler
+from budget.transport import Transport
 
 
 import requests
 import schedule
+from concurrent.futures import ThreadPoolExecutor
 from raven import Client
 
 
-def get_logger(debug=False):
+# How late a person's sync may be beyond its longest scheduled interval before healthchecks.io stops being pinged
+HEALTHCHECK_GRACE = timedelta(minutes=30)
+
+
+def get_logger(debug=False, stream=sys.stdout):
     root = logging.getLogger()
-    ch = logging.StreamHandler(sys.stdout)
+    ch = logging.StreamHandler(stream)
     formatter = logging.Formatter(
         '%(asctime)s - sync - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
@@ -57,11 +69,35 @@ def parse_arguments():
         help="Purge markers from database",
         action="store_true"
     )
+    args_parser.add_argument(
+        "--rebuild-totals",
+        help="Rebuild the monthly totals from the expenses in the database",
+        action="store_true"
+    )
+    args_parser.add_argument(
+        "--export",
+        help="Export all expenses in the database",
+        choices=sorted(EXPORT_FORMATS)
+    )
+    args_parser.add_argument(
+        "--export-file",
+        help="File to export expenses to, defaults to standard output",
+    )
     args_parser.add_argument(
         "--sync",
         help="Perform sync of expenses from Splitwise",
         action="store_true"
     )
+    args_parser.add_argument(
+        "--reconcile",
+        help="Compare stored expenses with Splitwise month by month and repair the months that differ",
+        action="store_true"
+    )
+    args_parser.add_argument(
+        "--warm-start",
+        help="With --periodic, trust the stored expenses on start up and catch up in the background",
+        action="store_true"
+    )
     args_parser.add_argument(
         "--periodic",
         help="Perform periodic sync of expenses from Splitwise",
@@ -73,7 +109,7 @@ def parse_arguments():
 
 def set_up(args):
     config = Config(args.config)
-    db = Database(config.get_database_uri())
+    db = Database(config.get_database_uri(), pool_settings=config.get_database_pool_settings())
     db.create_tables()
 
     aggregator = Aggregator(db)
@@ -83,24 +119,54 @@ def set_up(args):
         aggregator=aggregator
     )
 
-    fixer = Fixer()
+    transport = Transport(**config.get_http_settings())
+    fixer = Fixer(db=db, transport=transport)
 
-    logger = get_logger(args.debug)
+    # An export written to stdout must not be interleaved with log lines
+    logger = get_logger(args.debug, stream=sys.stderr if args.export and not args.export_file else sys.stdout)
 
-    return config, db, slack, fixer, logger
+    return config, db, slack, fixer, transport, logger
 
 
 def main():
     args = parse_arguments()
 
-    config, db, slack, fixer, logger = set_up(args)
+    config, db, slack, fixer, transport, logger = set_up(args)
     sentry_client = Client(config.sentry_url)
+    category_cache = CategoryCache(db, ttl=config.get_splitwise_category_ttl())
+    scheduler = AdaptiveScheduler(db, **config.get_sync_scheduler_settings())
+    # Held while syncing or reconciling, so background and scheduled runs never overlap
+    sync_lock = threading.Lock()
+    healthcheck = {"reported_at": None}
 
     def report_success():
         """Report successful run to healthchecks.io"""
         if not args.debug:
             requests.get(config.healthchecks_url)
 
+    def report_health():
+        """Report to healthchecks.io while the last sync of every person succeeded and ran on schedule
+
+        Checked on every scheduler tick rather than after each sync, since idle people are only synced every
+        max_interval_minutes. Reports at most once per min_interval_minutes.
+        """
+        now = datetime.utcnow()
+        if healthcheck["reported_at"] is not None and now - healthcheck["reported_at"] < scheduler.min_interval:
+            return
+        for person in config.get_people():
+            last_marker = db.get_last_marker(user_id=person.user_id)
+            if last_marker is None or not last_marker.success:
+                return
+            # A sync that stopped being scheduled, e.g. behind a stuck run holding the lock, is not healthy
+            if now - last_marker.created_at.replace(tzinfo=None) > scheduler.longest_interval() + HEALTHCHECK_GRACE:
+                return
+        try:
+            report_success()
+        except requests.RequestException as e:
+            logger.warning("Could not report to healthchecks.io: %s" % e)
+            return
+        healthcheck["reported_at"] = now
+
     def purge_expenses():
         logger.info("Asked to purge all expenses in database")
         nbr_of_purged_records = db.purge_expenses()
@@ -111,40 +177,156 @@ def main():
         nbr_of_purged_records = db.purge_markers()
         logger.info("%d markers purged" % nbr_of_purged_records)
 
-    def purge_all():
-        purge_expenses()
-        purge_markers()
+    def rebuild_totals():
+        logger.info("Asked to rebuild monthly totals in database")
+        nbr_of_monthly_totals = db.rebuild_monthly_totals()
+        logger.info("%d monthly totals rebuilt" % nbr_of_monthly_totals)
+
+    def export_expenses():
+        serialise, _ = EXPORT_FORMATS[args.export]
+        rows = itertools.chain.from_iterable(
+            db.iter_expense_rows(person.user_id, EXPORT_COLUMNS) for person in config.get_people()
+        )
+        output = open(args.export_file, "w") if args.export_file else sys.stdout
+        try:
+            for line in serialise(rows):
+                output.write(line)
+        finally:
+            if args.export_file:
+                output.close()
+
+    def create_sync_handler(person):
+        splitwise = Splitwise(
+            config.get_splitwise_consumer(),
+            person,
+            page_size=config.get_splitwise_page_size(),
+            category_cache=category_cache,
+            transport=transport
+        )
+        return SyncHandler(
+            db=db,
+            person=person,
+            splitwise=splitwise,
+            fixer=fixer,
+            overlap=config.get_sync_overlap()
+        )
+
+    def sync_person(person):
+        """Sync a single person, using a session of its own for the worker thread"""
+        logger.info("Syncing for user %s" % person.name)
+        try:
+            create_sync_handler(person).execute(sentry_client)
 
-    def sync_expenses():
+            last_marker = db.get_last_marker(user_id=person.user_id)
+            last_successful_marker = None
+            if not last_marker.success:
+                last_successful_marker = db.get_last_successful_marker(user_id=person.user_id)
+            return last_marker, last_successful_marker
+        finally:
+            db.remove_session()
+
+    def sync_expenses(people=None):
         logger.info("Starting sync with Splitwise")
-        for person in config.get_people():
-            logger.info("Syncing for user %s" % person.name)
-            splitwise = Splitwise(config.get_splitwise_consumer(), person)
-            sync_handler = SyncHandler(
-                db=db,
-                person=person,
-                splitwise=splitwise,
-                fixer=fixer
-            )
+        people = config.get_people() if people is None else people
+        totals = Counter()
 
-            sync_handler.execute(sentry_client)
+        with ThreadPoolExecutor(max_workers=config.get_sync_concurrency()) as executor:
+            futures = [(person, executor.submit(sync_person, person)) for person in people]
 
-            last_marker = db.get_last_marker(user_id=person.user_id)
+        for person, future in futures:
+            try:
+                last_marker, last_successful_marker = future.result()
+            except Exception as e:
+                sentry_client.captureException()
+                logger.error("Sync for user %s failed: %s" % (person.name, e))
+                totals["failed"] += 1
+                scheduler.record(person.user_id, changed=True)
+                continue
+
+            changed = not last_marker.success or last_marker.nbr_of_updates + last_marker.nbr_of_deletes > 0
+            logger.info("Next sync for user %s at %s" % (person.name, scheduler.record(person.user_id, changed)))
 
             if not last_marker.success:
+                totals["failed"] += 1
                 logger.error("Sync for user %s failed: %s" % (person.name, last_marker.message))
-                last_successful_marker = db.get_last_successful_marker(user_id=person.user_id)
                 logger.info(
-                    "Last successful sync for user %s was at %s" % (person.name, last_successful_marker.created_at)
+                    "Last successful sync for user %s was at %s" % (
+                        person.name, last_successful_marker.created_at if last_successful_marker else None
+                    )
                 )
             else:
-                report_success()
+                totals["successful"] += 1
+                totals["updates"] += last_marker.nbr_of_updates
+                totals["unchanged"] += last_marker.nbr_of_unchanged or 0
+                totals["deletes"] += last_marker.nbr_of_deletes
+                totals["conversions"] += last_marker.nbr_of_conversions
                 logger.info("Sync for user %s successful" % person.name)
                 logger.info(
-                    "%d record(s) added/updated, %d record(s) deleted, %d currency conversion(s) performed" %
-                    (last_marker.nbr_of_updates, last_marker.nbr_of_deletes, last_marker.nbr_of_conversions)
+                    "%d record(s) added/updated, %d record(s) unchanged, %d record(s) deleted, "
+                    "%d currency conversion(s) performed" % (
+                        last_marker.nbr_of_updates, last_marker.nbr_of_unchanged or 0, last_marker.nbr_of_deletes,
+                        last_marker.nbr_of_conversions
+                    )
                 )
 
+        logger.info(
+            "Sync finished for %d user(s), %d successful, %d failed: "
+            "%d record(s) added/updated, %d record(s) unchanged, %d record(s) deleted, "
+            "%d currency conversion(s) performed" % (
+                len(people), totals["successful"], totals["failed"],
+                totals["updates"], totals["unchanged"], totals["deletes"], totals["conversions"]
+            )
+        )
+
+    def reconcile_expenses():
+        logger.info("Starting reconciliation with Splitwise")
+        for person in config.get_people():
+            sync_handler = create_sync_handler(person)
+            months = sync_handler.reconcile(sentry_client)
+            if months is None:
+                logger.error(
+                    "Reconciliation for user %s failed: %s" % (
+                        person.name, db.get_last_marker(user_id=person.user_id).message
+                    )
+                )
+                continue
+            logger.info(
+                "Reconciliation for user %s repaired %d month(s)%s: %d record(s) added/updated, "
+                "%d record(s) deleted" % (
+                    person.name, len(months),
+                    " (%s)" % ", ".join("%04d-%02d" % month for month in months) if months else "",
+                    sync_handler.nbr_of_updates, sync_handler.nbr_of_deletes
+                )
+            )
+
+    def sync_due_expenses():
+        # Skip this check if a sync is still running, e.g. the one catching up after a warm start. A run that
+        # never finishes then stops the reports to healthchecks.io as well.
+        if not sync_lock.acquire(False):
+            return
+        try:
+            people = scheduler.due(config.get_people())
+            if people:
+                sync_expenses(people)
+            report_health()
+        finally:
+            sync_lock.release()
+
+    def reconcile_expenses_exclusively():
+        with sync_lock:
+            reconcile_expenses()
+
+    def warm_start():
+        """Resume incremental syncs from each person's last successful marker, then notify on Slack"""
+        try:
+            with sync_lock:
+                sync_expenses()
+            slack_notifications()
+        except Exception:
+            sentry_client.captureException()
+        finally:
+            db.remove_session()
+
     def slack_notifications():
         for person in config.get_people():
             last_marker = db.get_last_marker(user_id=person.user_id)
@@ -162,8 +344,18 @@ def main():
     if args.purge_markers:
         purge_markers()
 
+    if args.rebuild_totals:
+        rebuild_totals()
+
+    if args.export:
+        export_expenses()
+
+    if args.reconcile and not args.periodic:
+        reconcile_expenses()
+
     if args.sync and not args.periodic:
         sync_expenses()
+        report_health()
 
     if args.periodic:
         try:
@@ -172,19 +364,26 @@ def main():
             for person in config.get_people():
                 logger.info("Configured to sync for: %s", person.name)
 
-            # Purge and sync after just starting up
-            purge_all()
-            sync_expenses()
-
-            schedule.every(15).minutes.do(sync_expenses)
-            schedule.every().monday.do(purge_all)
+            # Each person is synced on their own adaptive schedule, checked every minute
+            schedule.every().minute.do(sync_due_expenses)
+            schedule.every().monday.do(reconcile_expenses_exclusively)
 
             # Schedule Slack notifications
             for moment in config.get_slack_config().schedule:
                 schedule.every().day.at(moment).do(slack_notifications)
 
-            # Send off initial Slack notification when starting up
-            slack_notifications()
+            if args.warm_start:
+                # Catch up and send the initial Slack notification in the background, with the scheduler running
+                logger.info("Warm start, resuming from the stored expenses and markers")
+                initial_run = threading.Thread(target=warm_start, name="warm-start")
+                initial_run.daemon = True
+                initial_run.start()
+            else:
+                # Repair anything that drifted while not running, leaving the stored expenses in place meanwhile
+                reconcile_expenses()
+
+                # Send off initial Slack notification when starting up
+                slack_notifications()
 
             while True:
                 schedule.run_pending()
@@ -4,11 +4,14 @@ import unittest
 
 from datetime import date, datetime
 
+from mock import Mock
+
 path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
 sys.path.insert(1, path)
 
 from aggregator import *
 from database import *
+from helpers import make_expense
 
 
 class TestAggregator(unittest.TestCase):
@@ -29,6 +32,120 @@ class TestAggregator(unittest.TestCase):
             date(2016, 10, 31)
         )
 
+    def _add_expenses(self):
+        self.db.upsert_expenses([
+            make_expense(1, created_at=datetime(2016, 10, 1), group='Home', cost=10.5),
+            make_expense(2, created_at=datetime(2016, 10, 31, 23, 0), group='Home', cost=4.25),
+            make_expense(3, created_at=datetime(2016, 10, 15), group='Home', child_category='Dining out', cost=20.0),
+            make_expense(4, created_at=datetime(2016, 10, 2), group='Travel', child_category='Other', cost=3.0),
+            make_expense(5, created_at=datetime(2016, 11, 1), group='Home', cost=7.0)
+        ])
+
+    def testExpensesForMonth(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        result = Aggregator(self.db).get_expenses_for_month(person, 2016, 10)
+
+        self.assertEquals(result["total_sum"], 37.75)
+        self.assertEquals(dict(result["total_sum_by_group"]), {"Home": 34.75, "Travel": 3.0})
+        self.assertEquals(
+            [(c["name"], c["total_sum"], len(c["expenses"])) for c in result["total_sum_by_category"]["Home"]],
+            [("Dining out", 20.0, 1), ("Groceries", 14.75, 2)]
+        )
+        self.assertEquals(
+            [(c["name"], c["total_sum"]) for c in result["total_sum_by_category"]["Travel"]],
+            [("Other Food", 3.0)]
+        )
+
+    def testExpensesBetweenWithoutDetail(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        aggregator = Aggregator(self.db)
+        result = aggregator.get_expenses_between(person, date(2016, 10, 1), date(2016, 10, 31))
+        month_summary = aggregator.get_expenses_for_month(person, 2016, 10, detail=False)
+        self.assertEquals(result, month_summary)
+        self.assertEquals(result["total_sum"], 37.75)
+        self.assertEquals(
+            result["total_sum_by_category"]["Home"],
+            [
+                {"name": "Dining out", "parent_category": "Food", "child_category": "Dining out", "total_sum": 20.0},
+                {"name": "Groceries", "parent_category": "Food", "child_category": "Groceries", "total_sum": 14.75}
+            ]
+        )
+
+    def testExpensesForMonthSummaryOnly(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        result = Aggregator(self.db).get_expenses_for_month(person, 2016, 10, detail=False, by_category=False)
+        self.assertEquals(result, {"total_sum_by_group": {"Home": 34.75, "Travel": 3.0}, "total_sum": 37.75})
+
+    def testExpensesForMonthColumnar(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        result = Aggregator(self.db).get_expenses_for_month(person, 2016, 10, columnar=True)
+        groceries = result["total_sum_by_category"]["Home"][1]["expenses"]
+        self.assertEquals(groceries["id"], [1, 2])
+        self.assertEquals(groceries["cost"], ["10.50", "4.25"])
+        self.assertEquals(result["total_sum"], 37.75)
+
+    def testSummaryForYear(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        aggregator = Aggregator(self.db)
+        summary = aggregator.get_summary_for_year(person, 2016)
+        self.assertEquals(summary["year"], 2016)
+        self.assertEquals(summary["total_sum"], 44.75)
+        self.assertEquals(summary["total_sum_by_group"], {"Home": 41.75, "Travel": 3.0})
+        self.assertEquals(
+            [(c["name"], c["total_sum"]) for c in summary["total_sum_by_category"]["Home"]],
+            [("Groceries", 21.75), ("Dining out", 20.0)]
+        )
+        self.assertEquals(len(summary["months"]), 12)
+        self.assertEquals(
+            summary["months"]["2016-10"],
+            aggregator.get_expenses_for_month(person, 2016, 10, detail=False)
+        )
+        self.assertEquals(summary["months"]["2016-01"]["total_sum"], 0.0)
+
+        year_to_date = aggregator.get_summary_for_year(person, 2016, to_month=10)
+        self.assertEquals(sorted(year_to_date["months"].keys())[-1], "2016-10")
+        self.assertEquals(year_to_date["total_sum"], 37.75)
+
+    def testExpensesForCategory(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        aggregator = Aggregator(self.db)
+        result = aggregator.get_expenses_for_category(person, 2016, 10, 'Home', 'Food', 'Groceries')
+        self.assertEquals(result["name"], "Groceries")
+        self.assertEquals(result["total_sum"], 14.75)
+        self.assertEquals([expense["id"] for expense in result["expenses"]], [1, 2])
+
+        detailed = aggregator.get_expenses_for_month(person, 2016, 10)
+        self.assertEquals(result["expenses"], detailed["total_sum_by_category"]["Home"][1]["expenses"])
+        self.assertEquals(
+            aggregator.get_expenses_for_category(person, 2016, 10, 'Travel', 'Food', 'Groceries')["expenses"], []
+        )
+
+    def testExpensesForMonths(self):
+        self._add_expenses()
+        person = Mock(user_id=2)
+        aggregator = Aggregator(self.db)
+        result = aggregator.get_expenses_for_months(person, 2016, 9, 2016, 11)
+        self.assertEquals(sorted(result["months"].keys()), ["2016-09", "2016-10", "2016-11"])
+        self.assertEquals(result["total_sum"], 44.75)
+        self.assertEquals(result["months"]["2016-09"]["total_sum"], 0.0)
+        self.assertEquals(
+            result["months"]["2016-10"],
+            aggregator.get_expenses_for_month(person, 2016, 10, detail=False)
+        )
+        self.assertEquals(result["months"]["2016-11"]["total_sum_by_group"], {"Home": 7.0})
+
+        detailed = aggregator.get_expenses_for_months(person, 2016, 10, 2016, 11, detail=True)
+        self.assertEquals(
+            detailed["months"]["2016-10"],
+            aggregator.get_expenses_for_month(person, 2016, 10, detail=True)
+        )
+
 
 def main():
     unittest.main()
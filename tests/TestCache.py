@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+
+from datetime import datetime
+
+from mock import Mock
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
+sys.path.insert(1, path)
+
+from aggregator import Aggregator
+from cache import *
+from database import *
+from helpers import make_expense
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("sqlite:///:memory:")
+        self.db.create_tables()
+        self.person = Mock(user_id=2)
+
+    def testLRUEviction(self):
+        cache = LRUCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEquals(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEquals(cache.get("b"), None, "Least recently used entry should be evicted")
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("c"), 3)
+        self.assertEquals(len(cache), 2)
+
+    def testCachedAggregatorInvalidatedByDataVersion(self):
+        aggregator = Aggregator(self.db)
+        aggregator.get_expenses_for_month = Mock(side_effect=aggregator.get_expenses_for_month)
+        cached_aggregator = CachedAggregator(aggregator, self.db)
+
+        self.db.upsert_expenses([make_expense(1, group='Home', created_at=datetime(2016, 10, 1), cost=10.0)])
+        self.assertEquals(cached_aggregator.get_expenses_for_month(self.person, 2016, 10)["total_sum"], 10.0)
+        self.assertEquals(cached_aggregator.get_expenses_for_month(self.person, 2016, 10)["total_sum"], 10.0)
+        self.assertEquals(aggregator.get_expenses_for_month.call_count, 1)
+
+        # A write by a sync, possibly in another process, increases the data version
+        self.db.upsert_expenses([make_expense(2, group='Home', created_at=datetime(2016, 10, 2), cost=5.0)])
+        self.assertEquals(cached_aggregator.get_expenses_for_month(self.person, 2016, 10)["total_sum"], 15.0)
+        self.assertEquals(aggregator.get_expenses_for_month.call_count, 2)
+
+        self.db.delete_expenses_by_id([1])
+        self.assertEquals(cached_aggregator.get_expenses_for_month(self.person, 2016, 10)["total_sum"], 5.0)
+
+        self.db.purge_expenses()
+        self.assertEquals(cached_aggregator.get_expenses_for_month(self.person, 2016, 10)["total_sum"], 0.0)
+        self.assertEquals(aggregator.get_expenses_for_month.call_count, 4)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
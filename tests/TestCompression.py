@@ -0,0 +1,71 @@
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from werkzeug.http import parse_accept_header
+from werkzeug.wrappers import Response
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
+sys.path.insert(1, path)
+
+from compression import *
+
+
+class TestCompression(unittest.TestCase):
+
+    def _json_response(self, size):
+        response = Response(json.dumps({"data": "x" * size}), mimetype="application/json")
+        response.set_etag("version")
+        return response
+
+    def testCompressResponse(self):
+        response = compress_response(self._json_response(2048), parse_accept_header("gzip, deflate"), min_size=1024)
+        self.assertEquals(response.headers["Content-Encoding"], "gzip")
+        self.assertEquals(response.get_etag(), ("version", True))
+        self.assertIn("Accept-Encoding", response.vary)
+        body = gzip.GzipFile(fileobj=StringIO(response.get_data())).read()
+        self.assertEquals(len(json.loads(body)["data"]), 2048)
+
+    def testSmallOrUnacceptedResponsesAreNotCompressed(self):
+        small = compress_response(self._json_response(10), parse_accept_header("gzip"), min_size=1024)
+        self.assertNotIn("Content-Encoding", small.headers)
+        unaccepted = compress_response(self._json_response(2048), parse_accept_header("identity"), min_size=1024)
+        self.assertNotIn("Content-Encoding", unaccepted.headers)
+        self.assertEquals(unaccepted.get_etag(), ("version", False))
+
+    def testBuildStatic(self):
+        static_folder = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(static_folder, "main.js"), "w") as f:
+                f.write("var a = 1;")
+            with open(os.path.join(static_folder, "index.html"), "w") as f:
+                f.write('<script src="/static/main.js"></script><img src="/static/logo.png">')
+
+            manifest = build_static(static_folder)
+            self.assertEquals(manifest, {"main.js": fingerprinted_name("main.js", "var a = 1;")})
+            self.assertEquals(load_manifest(static_folder), manifest)
+            with open(os.path.join(static_folder, "index.html")) as f:
+                self.assertEquals(
+                    f.read(),
+                    '<script src="/static/%s"></script><img src="/static/logo.png">' % manifest["main.js"]
+                )
+            with gzip.open(os.path.join(static_folder, manifest["main.js"] + ".gz")) as f:
+                self.assertEquals(f.read(), "var a = 1;")
+
+            # Building again leaves the fingerprinted names alone
+            self.assertEquals(build_static(static_folder), manifest)
+        finally:
+            shutil.rmtree(static_folder)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import os
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 
 from datetime import date, datetime
@@ -8,6 +11,8 @@ path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
 sys.path.insert(1, path)
 
 from database import *
+from helpers import make_expense
+from sqlalchemy import create_engine, inspect
 
 
 class TestDatabase(unittest.TestCase):
@@ -186,6 +191,151 @@ class TestDatabase(unittest.TestCase):
             None
         )
 
+    def testCurrencyConversionsStoredByAnotherProcess(self):
+        directory = tempfile.mkdtemp()
+        try:
+            uri = "sqlite:///%s" % os.path.join(directory, "budget.db")
+            db = Database(uri)
+            db.create_tables()
+            other_db = Database(uri)
+            self.assertEquals(db.get_currency_conversion_rates(date(2016, 10, 22), "EUR"), {})
+
+            other_db.add_currency_conversions(date(2016, 10, 22), "EUR", {"EUR": 1.0, "GBP": 0.9})
+            self.assertEquals(db.get_currency_conversion_rates(date(2016, 10, 22), "EUR"), {"EUR": 1.0, "GBP": 0.9})
+            db.engine.dispose()
+            other_db.engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+    def testUpsertExpenses(self):
+        nbr_of_upserts = self.db.upsert_expenses([make_expense(i) for i in range(1, 121)])
+        self.assertEquals(nbr_of_upserts, 120)
+        self.assertEquals(len(self.db.get_expenses(user_id=2)), 120)
+
+        nbr_of_upserts = self.db.upsert_expenses([
+            make_expense(1, description='Updated', cost=2.5), make_expense(121, description='New', cost=3.0)
+        ])
+        self.assertEquals(nbr_of_upserts, 2)
+        self.assertEquals(len(self.db.get_expenses(user_id=2)), 121)
+        updated = self.db.session.query(Expense).filter_by(id=1).first()
+        self.assertEquals(updated.description, 'Updated')
+        self.assertEquals(updated.cost, 2.5)
+
+        # Expenses identical to the stored ones are not written again
+        data_version = self.db.get_data_version(user_id=2)
+        nbr_of_upserts = self.db.upsert_expenses([make_expense(1, description='Updated', cost=2.5), make_expense(2)])
+        self.assertEquals(nbr_of_upserts, 0)
+        self.assertEquals(self.db.get_data_version(user_id=2), data_version)
+
+        nbr_of_deletes = self.db.delete_expenses_by_id(range(1, 61))
+        self.assertEquals(nbr_of_deletes, 60)
+        self.assertEquals(len(self.db.get_expenses(user_id=2)), 61)
+        data_version = self.db.get_data_version(user_id=2)
+
+        # Expenses that are already gone are not counted and leave cached aggregates valid
+        nbr_of_deletes = self.db.delete_expenses_by_id([1, 2, 61])
+        self.assertEquals(nbr_of_deletes, 1)
+        self.assertEquals(self.db.get_data_version(user_id=2), data_version + 1)
+        self.assertEquals(self.db.delete_expenses_by_id([1, 2, 61]), 0)
+        self.assertEquals(self.db.get_data_version(user_id=2), data_version + 1)
+
+    def testMigrateCreatesMissingIndexes(self):
+        self.assertEquals(self.db.get_schema_version(), len(MIGRATIONS))
+        self.assertEquals(self.db.migrate(), [])
+
+        # Simulate a database created before the indexes were introduced
+        for table in [Expense.__table__, Marker.__table__, CurrencyConversion.__table__]:
+            for index in table.indexes:
+                index.drop(bind=self.db.engine)
+        self.db.session.query(SchemaVersion).delete()
+        self.db.session.commit()
+        self.assertEquals(self.db.get_schema_version(), 0)
+
+        self.assertEquals(self.db.migrate(), range(1, len(MIGRATIONS) + 1))
+        index_names = [index["name"] for index in inspect(self.db.engine).get_indexes("markers")]
+        self.assertIn('ix_markers_user_id_success_created_at', index_names)
+        self.assertEquals(self.db.get_schema_version(), len(MIGRATIONS))
+
+    def testMigrateAddsMissingColumns(self):
+        directory = tempfile.mkdtemp()
+        try:
+            uri = "sqlite:///%s" % os.path.join(directory, "budget.db")
+            # Simulate a database created before content hashes and unchanged counts were introduced
+            engine = create_engine(uri)
+            engine.execute(
+                'CREATE TABLE expenses (id INTEGER PRIMARY KEY, user_id INTEGER, group_id INTEGER, "group" VARCHAR, '
+                'created_at DATETIME, description VARCHAR, parent_category VARCHAR, child_category VARCHAR, '
+                'cost FLOAT, original_currency VARCHAR, currency VARCHAR)'
+            )
+            engine.execute(
+                "CREATE TABLE markers (id INTEGER PRIMARY KEY, created_at DATETIME, user_id INTEGER, success BOOLEAN, "
+                "nbr_of_updates INTEGER, nbr_of_deletes INTEGER, nbr_of_conversions INTEGER, message VARCHAR)"
+            )
+            engine.execute(
+                "INSERT INTO expenses VALUES (1, 2, 0, 'Expense', '2016-10-22 00:00:00.000000', 'Old', 'Life', "
+                "'Groceries', 1.5, 'GBP', 'GBP')"
+            )
+            engine.dispose()
+
+            db = Database(uri)
+            db.create_tables()
+            self.assertIn("content_hash", [column["name"] for column in inspect(db.engine).get_columns("expenses")])
+            self.assertIn("nbr_of_unchanged", [column["name"] for column in inspect(db.engine).get_columns("markers")])
+            expense = db.session.query(Expense).get(1)
+            self.assertEquals(expense.content_hash, Expense.content_hash_of(expense.as_row()))
+            db.add_marker(2, datetime(2016, 10, 23), True, 0, 0, 0, None, nbr_of_unchanged=1)
+            self.assertEquals(db.get_last_marker(user_id=2).nbr_of_unchanged, 1)
+            db.engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+    def testMonthlyTotals(self):
+        def totals(year, month):
+            return sorted(
+                (t.category, t.total, t.count) for t in self.db.get_monthly_totals(user_id=2, year=year, month=month)
+            )
+
+        self.db.upsert_expenses([
+            make_expense(1, created_at=datetime(2016, 10, 1), cost=10.5),
+            make_expense(2, created_at=datetime(2016, 10, 31, 23, 0), cost=4.25),
+            make_expense(3, created_at=datetime(2016, 10, 15), child_category='Dining out', cost=20.0),
+            make_expense(4, created_at=datetime(2016, 11, 2), cost=3.0)
+        ])
+        self.assertEquals(totals(2016, 10), [('Food/Dining out', 20.0, 1), ('Food/Groceries', 14.75, 2)])
+        self.assertEquals(totals(2016, 11), [('Food/Groceries', 3.0, 1)])
+
+        # Changing the cost, category and month of expenses moves their share of the totals
+        self.db.upsert_expenses([
+            make_expense(1, created_at=datetime(2016, 10, 1), cost=12.5),
+            make_expense(3, created_at=datetime(2016, 11, 15), child_category='Dining out', cost=20.0)
+        ])
+        self.assertEquals(totals(2016, 10), [('Food/Groceries', 16.75, 2)])
+        self.assertEquals(totals(2016, 11), [('Food/Dining out', 20.0, 1), ('Food/Groceries', 3.0, 1)])
+
+        self.db.delete_expenses_by_id([2, 4])
+        self.assertEquals(totals(2016, 10), [('Food/Groceries', 12.5, 1)])
+        self.assertEquals(totals(2016, 11), [('Food/Dining out', 20.0, 1)])
+
+        # Drift is repaired by rebuilding from the expenses
+        self.db.session.query(MonthlyTotal).delete()
+        self.db.session.commit()
+        self.assertEquals(totals(2016, 10), [])
+        self.assertEquals(self.db.rebuild_monthly_totals(), 2)
+        self.assertEquals(totals(2016, 10), [('Food/Groceries', 12.5, 1)])
+        self.assertEquals(totals(2016, 11), [('Food/Dining out', 20.0, 1)])
+
+    def testSessionPerThread(self):
+        sessions = []
+
+        def use_session():
+            sessions.append(self.db.session())
+            self.db.remove_session()
+
+        thread = threading.Thread(target=use_session)
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], self.db.session())
+
 
 def main():
     unittest.main()
@@ -0,0 +1,52 @@
+import json
+import os
+import sys
+import unittest
+
+from datetime import datetime
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
+sys.path.insert(1, path)
+
+from database import *
+from export import *
+from helpers import make_expense
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("sqlite:///:memory:")
+        self.db.create_tables()
+        self.db.upsert_expenses([
+            make_expense(id, group='Home', created_at=datetime(2016, 10, id), description=u'Caf\xe9 %d' % id,
+                         child_category='Dining out', cost=id * 1.5) for id in [3, 1, 2]
+        ])
+
+    def testNdjson(self):
+        lines = list(iter_ndjson(self.db.iter_expense_rows(2, EXPORT_COLUMNS, batch_size=2)))
+        self.assertEquals(len(lines), 3)
+        expenses = [json.loads(line) for line in lines]
+        self.assertEquals([expense["id"] for expense in expenses], [1, 2, 3])
+        self.assertEquals(expenses[0]["created_at"], "2016-10-01T00:00:00")
+        self.assertEquals(expenses[0]["cost"], "1.50")
+        self.assertEquals(expenses[0]["description"], u'Caf\xe9 1')
+
+    def testCsv(self):
+        lines = list(iter_csv(self.db.iter_expense_rows(2, EXPORT_COLUMNS, batch_size=2)))
+        self.assertEquals(len(lines), 4)
+        self.assertEquals(lines[0], ",".join(EXPORT_COLUMNS) + "\r\n")
+        self.assertEquals(
+            lines[2],
+            "2,2,0,Home,2016-10-02T00:00:00,Caf\xc3\xa9 2,Food,Dining out,3.00,GBP,GBP\r\n"
+        )
+
+    def testOtherUsersAreNotExported(self):
+        self.assertEquals(list(iter_ndjson(self.db.iter_expense_rows(3, EXPORT_COLUMNS))), [])
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import json
 import os
 import sys
+import threading
 import unittest
 
 from datetime import date
@@ -12,6 +13,7 @@ path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
 sys.path.insert(1, path)
 
 
+from database import CurrencyConversion, Database
 from fixer import Fixer
 
 
@@ -121,6 +123,105 @@ class TestFixer(unittest.TestCase):
             "http://api.fixer.io/2016-10-21"
         )
 
+    def testRatesForDateAreFetchedAndStoredOnce(self):
+        db = Database("sqlite:///:memory:")
+        db.create_tables()
+        content = self._load_file_content("data/currency/2016-10-14.json")
+        m = Mock(return_value=content)
+
+        fixer = Fixer(db=db)
+        fixer._request = m
+        self.assertEquals(fixer.get_conversion_rate(date(2016, 10, 14), "SEK", "GBP"), 0.09)
+        self.assertEquals(fixer.get_conversion_rate(date(2016, 10, 14), "EUR", "GBP"), 0.9)
+        self.assertEquals(fixer.get_conversion_rate(date(2016, 10, 14), "GBP", "DKK"), 8.27)
+        self.assertEquals(m.call_count, 1)
+
+        # A new Fixer sharing the database derives rates from the stored table
+        other_fixer = Fixer(db=db)
+        other_fixer._request = m
+        self.assertEquals(other_fixer.get_conversion_rate(date(2016, 10, 14), "SEK", "GBP"), 0.09)
+        self.assertEquals(m.call_count, 1)
+        self.assertEquals(db.get_currency_conversion_rate(date(2016, 10, 14), "EUR", "SEK"), 9.7068)
+
+    def testPrefetchRates(self):
+        conversions = {
+            "2016-10-14": self._load_file_content("data/currency/2016-10-14.json"),
+            "2016-10-21": self._load_file_content("data/currency/2016-10-21.json")
+        }
+        m = Mock()
+        m.side_effect = lambda url: conversions[url.rsplit("/", 1)[1]]
+        self.fixer._request = m
+
+        dates = [date(2016, 10, 14), date(2016, 10, 21), date(2016, 10, 14)]
+        self.assertEquals(self.fixer.prefetch_rates(dates), 2)
+        self.assertEquals(m.call_count, 2)
+        self.assertEquals(self.fixer.prefetch_rates(dates), 0)
+        self.assertEquals(self.fixer.get_conversion_rate(date(2016, 10, 21), "EUR", "GBP"), 0.89)
+        self.assertEquals(m.call_count, 2)
+
+    def testLegacyStoredRatePairIsCompletedWithFullTable(self):
+        db = Database("sqlite:///:memory:")
+        db.create_tables()
+        # Stored by a version that saved single pairs rather than whole tables
+        db.add_currency_conversion(date(2016, 10, 14), 'EUR', 'GBP', 0.9)
+        m = Mock(return_value=self._load_file_content("data/currency/2016-10-14.json"))
+
+        fixer = Fixer(db=db)
+        fixer._request = m
+        self.assertEquals(fixer.prefetch_rates([date(2016, 10, 14)]), 1)
+        self.assertEquals(fixer.get_conversion_rate(date(2016, 10, 14), "SEK", "GBP"), 0.09)
+        self.assertEquals(m.call_count, 1)
+        self.assertEquals(db.session.query(CurrencyConversion).filter_by(to_currency='GBP').count(), 1)
+
+        # Another process sees the completed table and does not fetch it again
+        fixer = Fixer(db=db)
+        fixer._request = m
+        self.assertEquals(fixer.prefetch_rates([date(2016, 10, 14)]), 0)
+        self.assertEquals(m.call_count, 1)
+
+    def testSlowFetchDoesNotBlockOtherDates(self):
+        conversions = {
+            "2016-10-14": self._load_file_content("data/currency/2016-10-14.json"),
+            "2016-10-21": self._load_file_content("data/currency/2016-10-21.json")
+        }
+        slow_fetch_started = threading.Event()
+        release_slow_fetch = threading.Event()
+
+        def request(url):
+            for_date = url.rsplit("/", 1)[1]
+            if for_date == "2016-10-14":
+                slow_fetch_started.set()
+                release_slow_fetch.wait(10)
+            return conversions[for_date]
+
+        m = Mock(side_effect=request)
+        self.fixer._request = m
+        results = []
+        slow_threads = [
+            threading.Thread(target=lambda: results.append(self.fixer.prefetch_rates([date(2016, 10, 14)]))),
+            threading.Thread(
+                target=lambda: results.append(self.fixer.get_conversion_rate(date(2016, 10, 14), "SEK", "GBP"))
+            )
+        ]
+        slow_threads[0].start()
+        self.assertTrue(slow_fetch_started.wait(5))
+        slow_threads[1].start()
+
+        # Another date is fetched while the first is still in flight
+        other_results = []
+        other_thread = threading.Thread(
+            target=lambda: other_results.append(self.fixer.get_conversion_rate(date(2016, 10, 21), "EUR", "GBP"))
+        )
+        other_thread.start()
+        other_thread.join(2)
+        self.assertEquals(other_results, [0.89])
+        release_slow_fetch.set()
+        for thread in slow_threads:
+            thread.join(5)
+        self.assertEquals(sorted(results), [0.09, 1])
+        self.assertEquals(m.call_count, 2)
+
+
 def main():
     unittest.main()
 
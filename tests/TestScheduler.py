@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+
+from datetime import datetime, timedelta
+
+from mock import Mock
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
+sys.path.insert(1, path)
+
+from database import *
+from scheduler import *
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("sqlite:///:memory:")
+        self.db.create_tables()
+        self.now = datetime(2016, 10, 22, 12, 0)
+
+    def _scheduler(self, jitter=0.0):
+        return AdaptiveScheduler(
+            self.db,
+            min_interval=timedelta(minutes=15),
+            max_interval=timedelta(minutes=60),
+            jitter=jitter
+        )
+
+    def testIntervalBacksOffWhileIdle(self):
+        scheduler = self._scheduler()
+        intervals = []
+        for changed in [False, False, False, False, True, False]:
+            next_run_at = scheduler.record(2, changed, now=self.now)
+            intervals.append(next_run_at - self.now)
+        self.assertEquals(
+            intervals,
+            [timedelta(minutes=minutes) for minutes in [15, 30, 60, 60, 15, 30]]
+        )
+
+    def testJitterStaysWithinBounds(self):
+        scheduler = self._scheduler(jitter=0.2)
+        next_runs = set(scheduler.record(user_id, False, now=self.now) for user_id in range(20))
+        self.assertGreater(len(next_runs), 1)
+        for next_run_at in next_runs:
+            self.assertTrue(self.now + timedelta(minutes=12) <= next_run_at <= self.now + timedelta(minutes=18))
+        self.assertEquals(scheduler.longest_interval(), timedelta(minutes=72))
+
+    def testDuePeopleAndStateSurvivesRestart(self):
+        active, idle, new = Mock(user_id=1), Mock(user_id=2), Mock(user_id=3)
+        scheduler = self._scheduler()
+        scheduler.record(active.user_id, True, now=self.now)
+        scheduler.record(idle.user_id, False, now=self.now)
+        scheduler.record(idle.user_id, False, now=self.now)
+
+        # A scheduler created after a restart picks up the stored state
+        scheduler = self._scheduler()
+        self.assertEquals(scheduler.due([active, idle, new], now=self.now), [new])
+        self.assertEquals(scheduler.due([active, idle, new], now=self.now + timedelta(minutes=20)), [active, new])
+        self.assertEquals(
+            scheduler.due([active, idle, new], now=self.now + timedelta(minutes=30)),
+            [active, idle, new]
+        )
+        self.assertEquals(scheduler.record(idle.user_id, False, now=self.now) - self.now, timedelta(minutes=60))
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
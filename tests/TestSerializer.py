@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+import unittest
+
+from datetime import datetime
+
+path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
+sys.path.insert(1, path)
+
+from database import *
+from helpers import make_expense
+from serializer import *
+
+
+class TestSerializer(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database("sqlite:///:memory:")
+        self.db.create_tables()
+        self.expenses = [
+            make_expense(id, group='Home', created_at=datetime(2016, 10, id, 18, 30), description=u'Caf\xe9 %d' % id,
+                         child_category='Dining out', cost=id * 1.25) for id in [1, 2, 3]
+        ]
+        self.db.upsert_expenses(self.expenses)
+
+    def _rows(self):
+        return self.db.get_expense_rows_between(2, datetime(2016, 10, 1), datetime(2016, 10, 31), EXPENSE_FIELDS)
+
+    def testRowsMatchExpenseDictionaries(self):
+        expenses = self.db.get_expenses_between(2, datetime(2016, 10, 1), datetime(2016, 10, 31))
+        self.assertEquals(
+            serialise_expense_rows(self._rows()),
+            [expense.as_dictionary() for expense in expenses]
+        )
+
+    def testColumnarLayout(self):
+        columns = serialise_expense_rows(self._rows(), columnar=True)
+        self.assertEquals(set(columns.keys()), set(EXPENSE_FIELDS))
+        self.assertEquals(columns["id"], [3, 2, 1])
+        self.assertEquals(columns["created_at"], ["2016-10-03", "2016-10-02", "2016-10-01"])
+        self.assertEquals(columns["cost"], ["3.75", "2.50", "1.25"])
+        self.assertEquals(serialise_expense_rows([], columnar=True), dict((field, []) for field in EXPENSE_FIELDS))
+
+    def testDumps(self):
+        data = {"expenses": serialise_expense_rows(self._rows(), columnar=True)}
+        encoded = dumps(data)
+        self.assertNotIn('": ', encoded)
+        self.assertNotIn('", "', encoded)
+        self.assertEquals(json.loads(encoded), data)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
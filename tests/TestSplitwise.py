@@ -15,6 +15,7 @@ path = os.path.abspath(os.path.join(os.path.dirname(__file__), '../budget'))
 sys.path.insert(1, path)
 
 from config import Person
+from database import Database
 from splitwise import *
 
 
@@ -39,6 +40,19 @@ class TestSplitwise(unittest.TestCase):
             "URL does not match"
         )
 
+    def testRequestUsesSharedTransport(self):
+        transport = Mock()
+        transport.request.return_value = '{"categories": []}'
+        splitwise = Splitwise(self.consumer, self.person, transport=transport)
+        other_splitwise = Splitwise(self.consumer, self.person, transport=transport)
+        self.assertEquals(splitwise.get_categories(), {})
+        self.assertEquals(other_splitwise.get_categories(), {})
+        self.assertEquals(transport.request.call_count, 2)
+        url, method = transport.request.call_args[0]
+        self.assertEquals(url, "https://secure.splitwise.com/api/v3.0/get_categories?")
+        self.assertEquals(method, "GET")
+        self.assertIs(transport.request.call_args[1]["auth"], other_splitwise.auth)
+
     def testParseDateWithoutTimeZone(self):
         splitwise = Splitwise(self.consumer, self.person)
         unaware = datetime(2015, 4, 18, 15, 30, 35)
@@ -143,8 +157,89 @@ class TestSplitwise(unittest.TestCase):
         expenses = splitwise.get_expenses(updated_after=datetime(2015, 4, 18, 15, 30, 35))
         self.assertEquals(
             requested_urls[1],
-            "https://secure.splitwise.com/api/v3.0/get_expenses?updated_after=2015-04-18"
+            "https://secure.splitwise.com/api/v3.0/get_expenses?updated_after=2015-04-18T15%3A30%3A35Z"
+        )
+
+    def testGetExpensePages(self):
+        splitwise = Splitwise(self.consumer, self.person, page_size=3)
+        expenses = self._load_json("data/expenses/mixed-expenses.json")
+        categories = self._load_json("data/categories.json")
+        m = Mock()
+
+        requested_urls = []
+
+        def mock_request(url):
+            requested_urls.append(url)
+            if "get_categories" in url:
+                return categories
+            query = dict(parameter.split("=") for parameter in url.split("?")[1].split("&"))
+            offset, limit = int(query["offset"]), int(query["limit"])
+            return {"expenses": expenses.get("expenses")[offset:offset + limit]}
+
+        m.side_effect = mock_request
+        splitwise.request = m
+        pages = list(splitwise.get_expense_pages())
+        self.assertEquals(
+            [len(page.new) for page in pages],
+            [3, 3, 2]
         )
+        self.assertEquals(
+            len(requested_urls),
+            4,
+            "Categories should be requested once, followed by one request per page"
+        )
+        self.assertEquals(
+            requested_urls[-1],
+            "https://secure.splitwise.com/api/v3.0/get_expenses?limit=3&offset=6"
+        )
+
+    def testCategoryCacheIsSharedAndPersisted(self):
+        db = Database("sqlite:///:memory:")
+        db.create_tables()
+        expenses = self._load_json("data/expenses/mixed-expenses.json")
+        categories = self._load_json("data/categories.json")
+
+        requested_urls = []
+
+        def mock_request(url):
+            requested_urls.append(url)
+            if "get_expenses" in url:
+                return expenses
+            if "get_categories" in url:
+                return categories
+
+        category_cache = CategoryCache(db)
+        for person in [self.person, Person("Other User", 4567, "other@example.com", defaultdict(lambda: "Expense"),
+                                           "GBP", "abc", "xyz", [])]:
+            splitwise = Splitwise(self.consumer, person, category_cache=category_cache)
+            splitwise.request = Mock(side_effect=mock_request)
+            splitwise.get_expenses()
+        self.assertEquals(
+            len([url for url in requested_urls if "get_categories" in url]),
+            1,
+            "Categories should only be fetched once"
+        )
+
+        # A new cache, e.g. after a restart, uses the persisted categories
+        splitwise = Splitwise(self.consumer, self.person, category_cache=CategoryCache(db))
+        splitwise.request = Mock(side_effect=mock_request)
+        self.assertEquals(len(splitwise.get_expenses().new), 8)
+        self.assertEquals(
+            len([url for url in requested_urls if "get_categories" in url]),
+            1,
+            "Persisted categories should be used"
+        )
+
+    def testCategoryCacheRefreshesOnUnknownCategory(self):
+        expenses = self._load_json("data/expenses/mixed-expenses.json")
+        categories = self._load_json("data/categories.json")
+        category_cache = CategoryCache()
+        category_cache.categories = {}
+        category_cache.fetched_at = datetime.utcnow() - timedelta(minutes=5)
+
+        splitwise = Splitwise(self.consumer, self.person, category_cache=category_cache)
+        splitwise.request = Mock(side_effect=[expenses, categories])
+        self.assertEquals(len(splitwise.get_expenses().new), 8)
 
     def testParseDateWithoutDelta(self):
         splitwise = Splitwise(self.consumer, self.person)
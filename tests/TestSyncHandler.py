@@ -6,7 +6,7 @@ import unittest
 import oauth2
 
 from collections import defaultdict
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 
 from mock import Mock, MagicMock
 
@@ -16,6 +16,7 @@ sys.path.insert(1, path)
 from config import Person
 from database import *
 from fixer import Fixer
+from helpers import make_expense
 from splitwise import Splitwise
 from sync_handler import SyncHandler
 
@@ -49,11 +50,14 @@ class TestSyncHandler(unittest.TestCase):
     def _fixer_with_mocked_conversion_rate(self):
         m = Mock()
 
-        def mock_currency_conversion(for_date, from_currency, to_currency):
-            return 0.09
+        self.requested_rate_dates = []
 
-        m.side_effect = mock_currency_conversion
-        self.fixer.get_conversion_rate = m
+        def mock_fetch_rates(for_date):
+            self.requested_rate_dates.append(for_date)
+            return {"EUR": 1.0, "GBP": 0.9, "DKK": 10.0, "SEK": 11.25}
+
+        m.side_effect = mock_fetch_rates
+        self.fixer._fetch_rates = m
 
     def setUp(self):
         self.person = Person("Test User", 1234, "test@example.com", defaultdict(lambda: "Expense"), "GBP", "abc", "xyz", [])
@@ -93,6 +97,9 @@ class TestSyncHandler(unittest.TestCase):
 
         self.sync_handler.execute()
 
+        # Only the DKK expense lacks a stored rate, so a single rate table is prefetched
+        self.assertEquals(self.requested_rate_dates, [date(2016, 5, 8)])
+
         marker = self.db.get_last_successful_marker(user_id=1234)
         self.assertNotEquals(
             marker.created_at,
@@ -169,6 +176,70 @@ class TestSyncHandler(unittest.TestCase):
                     expected_after_deletion[index][3],
                 )
 
+    def testOverlappingSyncRewritesNothing(self):
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self._fixer_with_mocked_conversion_rate()
+        self.sync_handler.execute()
+        self.assertEquals(self.sync_handler.nbr_of_updates, 4)
+        data_version = self.db.get_data_version(1234)
+
+        # The same expenses come back through the overlap window, unchanged
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self.sync_handler.execute()
+
+        cursor = self.db.session.query(Marker).filter_by(user_id=1234).order_by(Marker.created_at).first().created_at
+        self.assertIn(
+            "updated_after=%s" % (cursor - timedelta(minutes=5)).strftime("%Y-%m-%dT%H%%3A%M%%3A%SZ"),
+            self.requested_urls[-1]
+        )
+        self.assertEquals(self.sync_handler.nbr_of_updates, 0)
+        self.assertEquals(self.db.get_last_marker(user_id=1234).nbr_of_unchanged, 4)
+        self.assertEquals(self.db.get_data_version(1234), data_version)
+        self.assertEquals(len(self.db.get_expenses(user_id=1234)), 4)
+
+    def testReconcileRepairsOnlyMonthsThatDiffer(self):
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self._fixer_with_mocked_conversion_rate()
+        self.sync_handler.execute()
+        synced = [expense.as_row() for expense in self.db.get_expenses(user_id=1234)]
+        groceries = [expense for expense in self.db.get_expenses(user_id=1234) if expense.description == "Groceries"][0]
+
+        # Nothing differs, so only the listing is requested and nothing is written
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self.assertEquals(self.sync_handler.reconcile(), [])
+        self.assertEquals(len([url for url in self.requested_urls if "get_expenses" in url]), 1)
+
+        # Lose an expense in May and gain a stray one in April
+        self.db.delete_expenses_by_id([groceries.id])
+        self.db.upsert_expenses([make_expense(1, user_id=1234, created_at=datetime(2016, 4, 30), description='Stray')])
+
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self.assertEquals(self.sync_handler.reconcile(), [(2016, 4), (2016, 5)])
+        dated_urls = [url for url in self.requested_urls if "dated_after" in url]
+        self.assertEquals(len(dated_urls), 2)
+        self.assertIn("dated_after=2016-04-30", dated_urls[1])
+        self.assertIn("dated_before=2016-06-01", dated_urls[1])
+        self.assertEquals(self.sync_handler.nbr_of_updates, 1)
+        self.assertEquals(self.sync_handler.nbr_of_deletes, 1)
+        self.assertEquals([expense.as_row() for expense in self.db.get_expenses(user_id=1234)], synced)
+        self.assertTrue(self.db.get_last_marker(user_id=1234).success)
+
+    def testReconcileRewritesExpensesWithoutUpdatedAt(self):
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self._fixer_with_mocked_conversion_rate()
+        self.sync_handler.execute()
+        synced = [expense.as_row() for expense in self.db.get_expenses(user_id=1234)]
+
+        # Expenses stored before updated_at was kept, one of which drifted, are rewritten from the listing alone
+        self.db.session.query(Expense).update({Expense.updated_at: None})
+        self.db.session.query(Expense).filter_by(description="Shoes").update({Expense.cost: 1.0})
+        self.db.session.commit()
+        self._splitwise_with_mocked_expenses("data/expenses/mixed-expenses-sync.json")
+        self.assertEquals(self.sync_handler.reconcile(), [])
+        self.assertEquals(len([url for url in self.requested_urls if "get_expenses" in url]), 1)
+        self.assertEquals(self.sync_handler.nbr_of_updates, 4)
+        self.assertEquals([expense.as_row() for expense in self.db.get_expenses(user_id=1234)], synced)
+
 
 def main():
     unittest.main()
@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from database import Expense
+
+
+def make_expense(id, **kwargs):
+    """An expense in GBP for tests, any column can be overridden"""
+    columns = dict(
+        id=id,
+        user_id=2,
+        group_id=0,
+        group='Expense',
+        created_at=datetime(2016, 10, 22),
+        description='Expense %d' % id,
+        parent_category='Food',
+        child_category='Groceries',
+        cost=1.0,
+        currency='GBP',
+        original_currency='GBP'
+    )
+    columns.update(kwargs)
+    return Expense(**columns)
@@ -3,4 +3,9 @@ python tests/TestDatabase.py
 python tests/TestSplitwise.py
 python tests/TestFixer.py
 python tests/TestSyncHandler.py
-python tests/TestAggregator.py
\ No newline at end of file
+python tests/TestAggregator.py
+python tests/TestCache.py
+python tests/TestExport.py
+python tests/TestCompression.py
+python tests/TestSerializer.py
+python tests/TestScheduler.py
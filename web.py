@@ -1,14 +1,23 @@
 #!flask/bin/python
 import argparse
+import hashlib
+import mimetypes
+import os
+from datetime import datetime
 from functools import wraps
 
-from flask import Flask, jsonify, g, redirect, url_for, session, send_from_directory
+from flask import Flask, Response, jsonify, g, redirect, request, url_for, session, send_from_directory, \
+    stream_with_context
 from flask_login import LoginManager, login_user
 from flask_oauth2_login import GoogleLogin
 
 from budget.aggregator import Aggregator
+from budget.cache import CachedAggregator
+from budget.compression import PRECOMPRESSED_EXTENSIONS, compress_response, load_manifest, negotiate_encoding
 from budget.config import Config
 from budget.database import *
+from budget.export import EXPORT_COLUMNS, EXPORT_FORMATS
+from budget import serializer
 
 
 def parse_arguments():
@@ -24,6 +33,12 @@ def parse_arguments():
         help="Increase verbosity",
         action="store_true"
     )
+    args_parser.add_argument(
+        "--server",
+        help="Serve with Flask's development server or with waitress",
+        choices=["development", "waitress"],
+        default="development"
+    )
     args_parser.add_argument(
         "--user-email",
         help="Pre-authenticated user e-mail",
@@ -31,13 +46,19 @@ def parse_arguments():
     return args_parser.parse_args()
 
 
-app = Flask(__name__, static_url_path='/static')
+# Static files are served by send_static, which knows about the precompressed copies made at build time
+app = Flask(__name__, static_folder=None)
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+static_manifest = load_manifest(STATIC_FOLDER) or {}
+fingerprinted_assets = set(static_manifest.values())
 
 args = parse_arguments()
 
 config = Config(args.config)
-db = Database(config.get_database_uri())
-aggregator = Aggregator(db)
+db = Database(config.get_database_uri(), pool_settings=config.get_database_pool_settings())
+aggregator = CachedAggregator(Aggregator(db), db, max_size=config.get_aggregator_cache_size())
 
 if args.user_email:
     config.pre_authenticated_user = args.user_email
@@ -92,6 +113,16 @@ def before_request():
     g.user = user
 
 
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings, min_size=config.get_compression_min_size())
+
+
+@app.teardown_appcontext
+def remove_database_session(exception=None):
+    db.remove_session()
+
+
 @login_manager.user_loader
 def load_user(email):
     return config.get_user_by_email(email)
@@ -100,7 +131,33 @@ def load_user(email):
 @app.route("/")
 @login_required
 def index():
-    return app.send_static_file('index.html')
+    return send_static('index.html')
+
+
+@app.route("/static/<path:filename>")
+def send_static(filename):
+    """Send a static file, preferring a precompressed copy the client accepts
+
+    Fingerprinted assets never change under the same name, so clients may keep them for a year without asking.
+    """
+    available = [encoding for encoding, extension in PRECOMPRESSED_EXTENSIONS
+                 if os.path.isfile(os.path.join(STATIC_FOLDER, filename + extension))]
+    encoding = negotiate_encoding(request.accept_encodings, available)
+    if encoding is None:
+        response = send_from_directory(STATIC_FOLDER, filename)
+    else:
+        response = send_from_directory(
+            STATIC_FOLDER, filename + dict(PRECOMPRESSED_EXTENSIONS)[encoding],
+            mimetype=mimetypes.guess_type(filename)[0]
+        )
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.headers.pop("Expires", None)
+    if filename in fingerprinted_assets:
+        response.headers["Cache-Control"] = "public, max-age=%d, immutable" % STATIC_MAX_AGE
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 @google_login.login_success
@@ -116,23 +173,222 @@ def login_failure(e):
     return jsonify(error=str(e))
 
 
+@app.errorhandler(InvalidUsage)
+def handle_invalid_usage(error):
+    response = jsonify(error.to_dict())
+    response.status_code = error.status_code
+    return response
+
+
+# Years that can be asked for, well within what date arithmetic on the last day of a month can handle
+MIN_YEAR = 1900
+MAX_YEAR = 2100
+# Longest range of months a single request can aggregate
+MAX_RANGE_MONTHS = 120
+
+
+def validate_year(year):
+    if not MIN_YEAR <= year <= MAX_YEAR:
+        raise InvalidUsage(message="Invalid year, expected %d to %d" % (MIN_YEAR, MAX_YEAR), status_code=400)
+    return year
+
+
+def parse_year_and_month(year_and_month):
+    try:
+        year, month = [int(i) for i in year_and_month.split('-', 1)]
+    except (AttributeError, ValueError):
+        raise InvalidUsage(message="Invalid date", status_code=400)
+    if not 1 <= month <= 12:
+        raise InvalidUsage(message="Invalid date", status_code=400)
+    return validate_year(year), month
+
+
+# Flags for the aggregator's detail and by_category arguments, by the detail parameter of month responses
+MONTH_DETAILS = {
+    "none": (False, False),
+    "category": (False, True),
+    "expenses": (True, True)
+}
+
+
+def parse_month_detail():
+    """Map ?detail=none|category|expenses on month responses to the aggregator's detail and by_category flags"""
+    detail = request.args.get("detail", "expenses")
+    if detail not in MONTH_DETAILS:
+        raise InvalidUsage(message="Invalid detail, expected one of: none, category, expenses", status_code=400)
+    return MONTH_DETAILS[detail]
+
+
+def parse_layout():
+    """Whether ?layout=columns asks for expenses as parallel lists per field instead of a list of objects"""
+    layout = request.args.get("layout", "rows")
+    if layout not in ("rows", "columns"):
+        raise InvalidUsage(message="Invalid layout, expected one of: rows, columns", status_code=400)
+    return layout == "columns"
+
+
+def json_response(data):
+    return app.response_class(serializer.dumps(data), mimetype="application/json")
+
+
+def conditional_response(person, resource, build_response, period_start=None):
+    """Answer with 304 Not Modified if the client's copy of a resource is still current, without building it
+
+    Expenses can only change when a sync runs, so the latest marker for the user identifies their version.
+    Resources covering the current period, like this month, also change when the period rolls over, which
+    period_start accounts for.
+    """
+    marker = db.get_last_marker(user_id=person.user_id)
+    version = "%s:%s" % (marker.id, marker.created_at.isoformat()) if marker is not None else "none"
+    etag = hashlib.sha1("%s:%s:%s:%s" % (
+        person.user_id, version, resource, request.query_string
+    )).hexdigest()
+    last_modified = marker.created_at.replace(microsecond=0, tzinfo=None) if marker is not None else None
+    if period_start is not None:
+        last_modified = max(last_modified, period_start) if last_modified is not None else period_start
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        if_modified_since = request.if_modified_since
+        not_modified = last_modified is not None and if_modified_since is not None and \
+            last_modified <= if_modified_since.replace(tzinfo=None)
+
+    response = app.response_class(status=304) if not_modified else build_response()
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the response, but have to revalidate it before every use
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 @app.route("/api/v1.0/expenses/this_month")
 @login_required
 def get_expenses_for_this_month():
-    result = aggregator.get_expenses_for_this_month(person=g.user)
-    return jsonify(result)
+    now = datetime.now()
+    detail, by_category = parse_month_detail()
+    columnar = parse_layout()
+    return conditional_response(
+        g.user, "%04d-%02d" % (now.year, now.month),
+        lambda: json_response(aggregator.get_expenses_for_month(
+            person=g.user, year=now.year, month=now.month, detail=detail, by_category=by_category, columnar=columnar
+        )),
+        period_start=datetime(now.year, now.month, 1)
+    )
+
+
+@app.route("/api/v1.0/expenses/range")
+@login_required
+def get_expenses_for_range():
+    from_year, from_month = parse_year_and_month(request.args.get("from"))
+    to_year, to_month = parse_year_and_month(request.args.get("to"))
+    if (from_year, from_month) > (to_year, to_month):
+        raise InvalidUsage(message="Range ends before it starts", status_code=400)
+    if (to_year - from_year) * 12 + to_month - from_month >= MAX_RANGE_MONTHS:
+        raise InvalidUsage(message="Range spans more than %d months" % MAX_RANGE_MONTHS, status_code=400)
+    detail = request.args.get("detail", "category")
+    if detail not in ("category", "expenses"):
+        raise InvalidUsage(message="Invalid detail, expected one of: category, expenses", status_code=400)
+    columnar = parse_layout()
+    return conditional_response(
+        g.user, "range",
+        lambda: json_response(aggregator.get_expenses_for_months(
+            person=g.user,
+            from_year=from_year,
+            from_month=from_month,
+            to_year=to_year,
+            to_month=to_month,
+            detail=detail == "expenses",
+            columnar=columnar
+        ))
+    )
+
+
+@app.route("/api/v1.0/expenses/export")
+@login_required
+def export_expenses():
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        raise InvalidUsage(
+            message="Invalid format, expected one of: %s" % ", ".join(sorted(EXPORT_FORMATS)), status_code=400
+        )
+    serialise, content_type = EXPORT_FORMATS[export_format]
+    rows = db.iter_expense_rows(g.user.user_id, EXPORT_COLUMNS)
+    response = Response(stream_with_context(serialise(rows)), mimetype=content_type)
+    response.headers["Content-Disposition"] = "attachment; filename=expenses.%s" % export_format
+    return response
 
 
 @app.route("/api/v1.0/expenses/<year_and_month>")
 @login_required
 def get_expenses(year_and_month):
-    try:
-        year, month = [int(i) for i in year_and_month.split('-', 1)]
-    except ValueError:
-        raise InvalidUsage(message="Invalid date", status_code=400)
-    result = aggregator.get_expenses_for_month(person=g.user, year=year, month=month)
-    return jsonify(result)
+    year, month = parse_year_and_month(year_and_month)
+    detail, by_category = parse_month_detail()
+    columnar = parse_layout()
+    return conditional_response(
+        g.user, "%04d-%02d" % (year, month),
+        lambda: json_response(aggregator.get_expenses_for_month(
+            person=g.user, year=year, month=month, detail=detail, by_category=by_category, columnar=columnar
+        ))
+    )
+
+
+@app.route("/api/v1.0/expenses/<year_and_month>/category")
+@login_required
+def get_expenses_for_category(year_and_month):
+    if year_and_month == "this_month":
+        now = datetime.now()
+        year, month = now.year, now.month
+    else:
+        year, month = parse_year_and_month(year_and_month)
+    group = request.args.get("group")
+    parent_category = request.args.get("parent_category")
+    child_category = request.args.get("child_category")
+    if not group or not parent_category or not child_category:
+        raise InvalidUsage(message="Expected group, parent_category and child_category", status_code=400)
+    columnar = parse_layout()
+    return conditional_response(
+        g.user, "%04d-%02d/category" % (year, month),
+        lambda: json_response(aggregator.get_expenses_for_category(
+            person=g.user,
+            year=year,
+            month=month,
+            group=group,
+            parent_category=parent_category,
+            child_category=child_category,
+            columnar=columnar
+        ))
+    )
+
+@app.route("/api/v1.0/summary/ytd")
+@login_required
+def get_summary_for_year_to_date():
+    now = datetime.now()
+    return conditional_response(
+        g.user, "summary/%04d-%02d" % (now.year, now.month),
+        lambda: json_response(aggregator.get_summary_for_year(person=g.user, year=now.year, to_month=now.month)),
+        period_start=datetime(now.year, now.month, 1)
+    )
+
+
+@app.route("/api/v1.0/summary/<int:year>")
+@login_required
+def get_summary_for_year(year):
+    validate_year(year)
+    return conditional_response(
+        g.user, "summary/%04d" % year,
+        lambda: json_response(aggregator.get_summary_for_year(person=g.user, year=year))
+    )
 
 if __name__ == "__main__":
     host = '0.0.0.0' if not args.debug else '127.0.0.1'
-    app.run(host=host, debug=args.debug)
+    if args.server == "waitress":
+        from waitress import serve
+        # Waitress reads requests and writes responses for any number of clients on one I/O thread, so slow
+        # clients only hold a connection while a bounded pool of threads runs the app and its database queries
+        serve(app, host=host, port=5000, **config.get_web_server_settings())
+    else:
+        # Each request uses its own database session, so requests can be served concurrently
+        app.run(host=host, debug=args.debug, threaded=True)